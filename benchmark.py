@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+import utils as ut
+import gather_data as gd
+import model as md
+import remove_fringing as rf
+import version as v
+import header_index as hi
+import numpy as np
+from astropy.io import fits
+from zipfile import ZipFile, ZIP_DEFLATED
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import functools
+import threading
+import subprocess
+import tracemalloc
+import datetime
+import argparse
+import shutil
+import json
+import time
+import io
+import os
+
+"""Benchmark of all the stages of the codes, on synthetic IRiS images, without network access.
+
+Synthetic fringed images (sky, stars, interference pattern, 'EAST' and 'WEST' piersides) are put in zips,
+served with a local index page by a local HTTP server, then the codes are run on them:
+gather_images, gather_normalized_images and create_model (also with the images binned 4x4),
+delta_flux_ref (also with the preview model binned 4x4, expanded to the full resolution), ratio_med and remove_folder.
+The time and the peak memory (tracemalloc) of each stage are written in a .json file,
+to compare the results across versions of the code and across numbers of images."""
+
+# functions to make the synthetic data
+
+def fringe_pattern(shape, seed=0):
+    """returns a synthetic interference pattern of amplitude ~1 (EAST orientation):
+    a sum of a few plane waves whose amplitude varies slowly across the image"""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:shape[0], :shape[1]].astype(np.float64)
+    pattern = np.zeros(shape)
+    for wave in range(4):
+        angle = rng.uniform(0, np.pi)
+        period = rng.uniform(20, 80) # in pixels
+        phase = rng.uniform(0, 2 * np.pi)
+        pattern += np.sin(2 * np.pi * (rows * np.cos(angle) + cols * np.sin(angle)) / period + phase)
+    envelope = 1 + 0.5 * np.sin(np.pi * rows / shape[0]) * np.cos(np.pi * cols / shape[1])
+    return pattern * envelope / 4
+
+def synthetic_frame(pattern, rng, n_stars=200):
+    """returns a synthetic image (EAST orientation, float32) with a sky level, stars,
+    the interference pattern with a random amplitude, and noise"""
+    shape = pattern.shape
+    sky = rng.uniform(500, 3000)
+    data = sky + rng.uniform(5, 50) * pattern + rng.normal(0, np.sqrt(sky), shape)
+
+    # stars, gaussian profiles in stamps of 15x15 pixels
+    offsets = np.arange(-7, 8)
+    for star in range(n_stars):
+        row = rng.integers(7, shape[0] - 7)
+        col = rng.integers(7, shape[1] - 7)
+        sigma = rng.uniform(1, 3)
+        profile = np.exp(-(offsets[:, np.newaxis]**2 + offsets[np.newaxis, :]**2) / (2 * sigma**2))
+        data[row - 7:row + 8, col - 7:col + 8] += rng.uniform(100, 20000) * profile
+
+    return data.astype(np.float32)
+
+def synthetic_header(rng, pierside, date):
+    """returns the header of a synthetic calibrated image"""
+    header = fits.Header()
+    header['PIERSIDE'] = pierside
+    header['DATE-OBS'] = date.strftime('%Y-%m-%dT') + '{:02d}:{:02d}:00'.format(rng.integers(0, 24), rng.integers(0, 60))
+    ra = rng.uniform(0, 24)
+    dec = rng.uniform(-30, 80)
+    header['OBJCTRA'] = '{:02d} {:02d} {:05.2f}'.format(int(ra), int(ra * 60) % 60, (ra * 3600) % 60)
+    header['OBJCTDEC'] = '{}{:02d} {:02d} {:04.1f}'.format('-' if dec < 0 else '+', int(abs(dec)), int(abs(dec) * 60) % 60,
+                                                           (abs(dec) * 3600) % 60)
+    header['HISTORY'] = 'Bias, Dark and Flat corrections done (synthetic image)'
+    return header
+
+def fits_bytes(data, header):
+    """returns the content of a .fits file made with data and header"""
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data, header).writeto(buffer)
+    return buffer.getvalue()
+
+def make_archive(folder, archive, n_images, shape, band='i', per_zip=10, seed=0):
+    """makes the synthetic archive of IRiS in folder: the zips of the observations
+    (folder/observations/YYYYMMDD.zip, per_zip images each, plus an image with another shape
+    which must be rejected) and the page listing them (folder/index.html).
+    archive : the url of folder/observations/ on the server.
+
+    returns the first and the last dates of the observations"""
+
+    rng = np.random.default_rng(seed)
+    pattern = fringe_pattern(shape, seed)
+    os.makedirs(os.path.join(folder, 'observations'), exist_ok=True)
+
+    first_date = datetime.date(2023, 1, 1)
+    lines = ['<html><body>']
+    n_zips = (n_images + per_zip - 1) // per_zip
+    for id_zip in range(n_zips):
+        date = first_date + datetime.timedelta(days=id_zip)
+        name = date.strftime('%Y%m%d')
+        with ZipFile(os.path.join(folder, 'observations', name + '.zip'), 'w', ZIP_DEFLATED, compresslevel=1) as zip:
+            for id_image in range(id_zip * per_zip, min((id_zip + 1) * per_zip, n_images)):
+                pierside = 'WEST' if rng.random() < 0.5 else 'EAST'
+                data = synthetic_frame(pattern, rng)
+                if pierside == 'WEST':
+                    data = data[::-1, ::-1] # the image is saved as the telescope sees it
+                image_name = '{}/synthetic-S{:03d}-R001-C001-SDSS_{}.fits'.format(name, id_image, band)
+                zip.writestr(image_name, fits_bytes(data, synthetic_header(rng, pierside, date)))
+
+            # an image with another shape, rejected while reading its header
+            small = rng.normal(1000, 30, (64, 64)).astype(np.float32)
+            zip.writestr('{}/small-S001-R001-C001-SDSS_{}.fits'.format(name, band),
+                         fits_bytes(small, synthetic_header(rng, 'EAST', date)))
+        lines.append('<a href="{}{}.zip">{}</a>'.format(archive, name, name))
+    lines.append('</body></html>')
+
+    with open(os.path.join(folder, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines))
+
+    last_date = first_date + datetime.timedelta(days=n_zips - 1)
+    return int(first_date.strftime('%Y%m%d')), int(last_date.strftime('%Y%m%d'))
+
+def make_pairs(pairs_name, shape, n_pairs=200, seed=0):
+    """writes a control pairs file (ds9 format, as read by remove_fringing.read_pairs) for the synthetic
+    interference pattern: each pair goes from a bright point to a dark point of the pattern"""
+
+    rng = np.random.default_rng(seed + 1)
+    pattern = fringe_pattern(shape, seed)
+    margin = 20
+    rows = rng.integers(margin, shape[0] - margin, 50 * n_pairs)
+    cols = rng.integers(margin, shape[1] - margin, 50 * n_pairs)
+    values = pattern[rows, cols]
+    bright = np.argsort(values)[::-1][:n_pairs]
+    dark = np.argsort(values)[:n_pairs]
+
+    with open(pairs_name, 'w') as f:
+        f.write('# Region file format: DS9 version 4.1\n')
+        f.write('global color=green width=1\n')
+        f.write('image\n')
+        for b, d in zip(bright, dark):
+            # ds9 coordinates start at 1, x is the column
+            f.write('line({},{},{},{}) # line=0 0\n'.format(cols[b] + 1, rows[b] + 1, cols[d] + 1, rows[d] + 1))
+
+# the local server of the synthetic archive
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """serves the files of a folder without printing each request"""
+    def log_message(self, format, *args):
+        pass
+
+def start_server(folder):
+    """starts a local HTTP server of folder in a thread, returns the server and its url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=os.path.abspath(folder)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+# measure of the stages
+
+def measure(results, stage, function, *args, **kwargs):
+    """runs function(*args, **kwargs), records its time and its peak memory in results and returns its result.
+    The memory is the peak of the memory allocated during the stage (python and numpy) in the main process,
+    the memory used by the worker processes is not counted."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = function(*args, **kwargs)
+    duration = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append({'stage' : stage, 'time' : duration, 'peak memory' : peak / 1024**2})
+    print('{} : {:.2f} s, {:.1f} MB'.format(stage, duration, peak / 1024**2))
+    return result
+
+def ratios(images, pairs, delta_flux_model, delta_pixel):
+    """computes the ratio of each image (delta_flux_ref is done before), as remove does"""
+    return [rf.ratio_med(pairs, delta_flux_model, ut.load_image(image)[0], delta_pixel) for image in images]
+
+def run_benchmark(n_images, shape, N_samples, memory, workers, box_width, dtype, seed, per_zip):
+    """runs all the stages on n_images synthetic images in the current folder,
+    returns the list of the results of each stage"""
+
+    band = 'i'
+    results = []
+    delta_pixel = box_width // 2
+
+    os.mkdir('www')
+    server, url = start_server('www')
+    try:
+        print('\nmaking {} synthetic images of shape {}'.format(n_images, shape))
+        date1, date2 = make_archive('www', url + 'observations/', n_images, shape, band, per_zip, seed)
+        make_pairs('pairs.reg', shape, seed=seed)
+
+        measure(results, 'gather_images', gd.gather_images, date1, date2, band, 'images', (shape[1], shape[0]), False,
+                workers, 5, url + 'index.html', url + 'observations/', False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    fringe_maps, N_samples = measure(results, 'gather_normalized_images', ut.gather_normalized_images,
+                                     'images', N_samples, memory, 'tmp_fringe_maps.npy', workers, seed, dtype)
+    measure(results, 'create_model', md.create_model, fringe_maps, 'model.fits', 'images', N_samples, memory, dtype)
+    del fringe_maps
+
+    # the same model, previewed with the images binned 4x4
+    binning = 4 if (shape[0] % 4 == 0) and (shape[1] % 4 == 0) else 1
+    if binning > 1:
+        fringe_maps, N_samples = measure(results, 'gather_normalized_images 4x4', ut.gather_normalized_images,
+                                         'images', N_samples, memory, 'tmp_fringe_maps.npy', workers, seed, dtype,
+                                         binning=binning)
+        measure(results, 'create_model 4x4', md.create_model, fringe_maps, 'preview.fits', 'images', N_samples, memory, dtype,
+                binning=binning)
+        del fringe_maps
+
+    pairs = np.array(rf.read_pairs('pairs.reg'))
+    delta_flux_model, model = measure(results, 'delta_flux_ref', rf.delta_flux_ref, pairs, 'model.fits', delta_pixel)
+    if binning > 1:
+        measure(results, 'delta_flux_ref 4x4', rf.delta_flux_ref, pairs, 'preview.fits', delta_pixel)
+
+    images = hi.select_images('images')
+    measure(results, 'ratio_med', ratios, images, pairs, delta_flux_model, delta_pixel)
+    measure(results, 'remove', rf.remove_folder, images, pairs, model, delta_flux_model, delta_pixel,
+            'model.fits', 'pairs.reg', workers, False, dtype)
+
+    return results
+
+def git_commit():
+    """returns the commit of the code, or None if it is not in a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_name, new_name):
+    """prints the ratio of the times of each stage between two benchmark results (new / old)"""
+    with open(old_name, 'r') as f:
+        old = json.load(f)
+    with open(new_name, 'r') as f:
+        new = json.load(f)
+
+    print('{} ({}) -> {} ({})'.format(old_name, old['commit'], new_name, new['commit']))
+    old_runs = {run['images'] : run for run in old['runs']}
+    for run in new['runs']:
+        if run['images'] not in old_runs:
+            continue
+        old_stages = {stage['stage'] : stage for stage in old_runs[run['images']]['stages']}
+        print('\n{} images'.format(run['images']))
+        for stage in run['stages']:
+            if stage['stage'] in old_stages:
+                before = old_stages[stage['stage']]
+                print('- {} : time x{:.2f}, peak memory x{:.2f}'.format(stage['stage'], stage['time'] / before['time'],
+                                                                      stage['peak memory'] / max(before['peak memory'], 1e-6)))
+
+# functions to correctly read the setup file
+
+def read_parameter(text):
+    """reads a string with the format {parameter} \t ...
+    and returns the string parameter"""
+    parameter = text.split('\t')[0]
+    return parameter.strip()
+
+def take_input(txt):
+    """reads a text line with the format {text} \t {text} \t ...
+    and returns the last bloc of text, stripped, which is assumed to be
+    the input for a given parameter"""
+    input = txt.split('\t')[-1]
+    return input.strip()
+
+def read_int(num):
+    """convert a string into an int"""
+    return int(num)
+
+def read_int_list(text):
+    """reads a string with the format n1, n2, ... and returns the list of ints"""
+    return [int(num) for num in text.split(',')]
+
+def read_shape(shape):
+    """reads a string shape with the format s1 x s2
+    and returns the tuple (s1, s2)"""
+    shape = shape.split('x')
+    return (int(shape[0].strip()), int(shape[1].strip()))
+
+def do_nothing(x):
+    """just a convenient function for after"""
+    return x
+
+def read_setup(file, verbose):
+    """reads the setup file and returns the information in it"""
+
+    # setting the default parameters
+    work_folder = 'benchmark_work'
+    image_counts = [20]
+    shape = (2048, 2048)
+    N_samples = 5
+    memory = None
+    workers = 1
+    box_width = 11
+    dtype = np.dtype(np.float32)
+    seed = 0
+    per_zip = 10
+    output = 'benchmark_{}.json'.format(datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S'))
+
+    # list of the default parameters
+    param_list = [work_folder, image_counts, shape, N_samples, memory, workers, box_width, dtype, seed, per_zip, output]
+
+    # displays the default values if verbose
+    if verbose:
+        print("The default values for each parameter are :")
+        print("- work folder : {}".format(work_folder))
+        print("- number of images : {}".format(image_counts))
+        print("- image shape : {}".format(shape))
+        print("- number of samples : {}".format(N_samples))
+        print("- memory budget : {}".format(memory))
+        print("- number of workers : {}".format(workers))
+        print("- box width : {}".format(box_width))
+        print("- dtype : {}".format(dtype))
+        print("- seed : {}".format(seed))
+        print("- images per zip : {}".format(per_zip))
+        print("- output : {}".format(output))
+        print("\na message will be displayed each time a value is modified\n")
+
+    # list of all the parameters accepted by the code
+    input_list = ['work folder', 'number of images', 'image shape', 'number of samples', 'memory budget', 'number of workers',
+                  'box width', 'dtype', 'seed', 'images per zip', 'output']
+
+    # dictionnary with a function associated to each parameter if necessary to read them correctly
+    input_dic = {'work folder' : do_nothing,
+                 'number of images' : read_int_list,
+                 'image shape' : read_shape,
+                 'number of samples' : read_int,
+                 'memory budget' : read_int,
+                 'number of workers' : read_int,
+                 'box width' : read_int,
+                 'dtype' : ut.read_dtype,
+                 'seed' : read_int,
+                 'images per zip' : read_int,
+                 'output' : do_nothing}
+
+    # checking if there is a file
+    if file is not None:
+        text = open(file, 'r')
+    else:
+        print("no file was given, the parameters will stay at their default value\n")
+        return tuple(param_list)
+
+    # reads all the lines in the file and modify the parameters
+    for line in text:
+        to_read = line.split("#")[0].strip() # we don't read the comments
+        param = read_parameter(to_read) # taking the parameter which will be modified
+        try:
+            input_value = take_input(to_read) # taking the input value, to convert after
+
+            # converting the input value for the code, using a dictionnary of functions
+            param_idx = input_list.index(param)
+            input = input_list[param_idx]
+            input_value = input_dic[input](input_value)
+            param_list[param_idx] = input_value
+
+            # displays the changes if verbose
+            if verbose:
+                print("the parameter {} was set to {}".format(input, input_value))
+        except ValueError: # in case the parameter is not in the list (e. g. an empty line)
+            pass
+    text.close()
+
+    return tuple(param_list)
+
+if __name__ == "__main__":
+    # parsing the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', help="setup file of the benchmark")
+    parser.add_argument('-v', '--verbose', help="gives more information", action="store_true")
+    parser.add_argument('-c', '--compare', nargs=2, metavar=('OLD', 'NEW'), help="compares two results of the benchmark")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(args.compare[0], args.compare[1])
+        exit()
+
+    # reading the setup file
+    work_folder, image_counts, shape, N_samples, memory, workers, box_width, dtype, seed, per_zip, output = read_setup(args.file, args.verbose)
+    output = os.path.abspath(output)
+
+    report = {'date' : datetime.datetime.today().isoformat(timespec='seconds'),
+              'commit' : git_commit(),
+              'versions' : {'all' : v.version_all(), 'utils' : v.version_utils(), 'gather_data' : v.version_data(),
+                            'model' : v.version_model(), 'remove_fringing' : v.version_remove()},
+              'parameters' : {'image shape' : list(shape), 'number of samples' : N_samples, 'memory budget' : memory,
+                              'number of workers' : workers, 'box width' : box_width, 'dtype' : np.dtype(dtype).name,
+                              'seed' : seed, 'images per zip' : per_zip},
+              'runs' : []}
+
+    # each number of images is run in its own folder, made again from scratch
+    if not os.path.exists(work_folder):
+        os.mkdir(work_folder)
+    start = os.getcwd()
+    for n_images in image_counts:
+        run_folder = os.path.join(work_folder, '{}_images'.format(n_images))
+        if os.path.exists(run_folder):
+            shutil.rmtree(run_folder)
+        os.mkdir(run_folder)
+
+        os.chdir(run_folder) # the codes write their files (zips, fringe maps...) in the current folder
+        try:
+            stages = run_benchmark(n_images, shape, min(N_samples, n_images), memory, workers, box_width, dtype, seed, per_zip)
+        finally:
+            os.chdir(start)
+        report['runs'].append({'images' : n_images, 'stages' : stages})
+
+        # the results are written after each run, so that a long benchmark can be stopped
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    print('\nresults written in {}'.format(output))
\ No newline at end of file
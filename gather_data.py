@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 import utils as ut
-import wget
+import header_index as hi
+import profiling as pr
 import urllib.request
-from urllib.error import HTTPError, ContentTooShortError
+import urllib.parse
+import http.client
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 from zipfile import ZipFile, BadZipFile
-import glob
 import shutil
 import time
 from astropy.io import fits
@@ -14,16 +18,24 @@ import astropy.coordinates as ac
 from astropy import units as u
 import argparse
 import datetime
+import itertools
+import json
+import numpy as np
 
 """Automatically gathers images from the IRiS telescope at http://cesam.lam.fr/iris/."""
 
-def gather_url(date1, date2):
+INDEX_URL = "http://cesam.lam.fr/iris/" # the page listing all the observations
+ARCHIVE_URL = "http://iris.lam.fr/observations/" # where the zips of the observations are
+TRANSIENT_STATUS = (408, 429) # the client errors which are worth trying again (timeout, too many requests)
+REDIRECT_STATUS = (301, 302, 303, 307, 308) # the answers which send to another url (Location)
+
+def gather_url(date1, date2, url=INDEX_URL, archive=ARCHIVE_URL):
     """Gathers all the zip URLs to download the observations
     between date1 and date2 (date1 <= date2).
     
-    The dates (type : int) should be written as YYYYMMDD."""
+    The dates (type : int) should be written as YYYYMMDD.
+    url : the page listing the observations, archive : the beginning of the zip URLs"""
 
-    url = "http://cesam.lam.fr/iris/"
     reponse = urllib.request.urlopen(url)
 
     content = reponse.read().decode('UTF-8') # contains the HTML code of the page (str)
@@ -37,22 +49,189 @@ def gather_url(date1, date2):
         line = line.strip() # clear all the tabs
 
         # searches the urls to save and verify the date
-        expr1 = "http://iris.lam.fr/observations/" in line
+        expr1 = archive in line
         expr2 = ".zip" in line 
         expr3 = "-calib" not in line # we don't want calibration zips
         if expr1 and expr2 and expr3:
 
             # gets the date
-            line = line.split("http://iris.lam.fr/observations/")[-1]
+            line = line.split(archive)[-1]
             line = line.split(".zip")[0]
             date = int(line) 
 
             # compares with the interval given
             if date1 <= date and date2 >= date:
-                urls.append("http://iris.lam.fr/observations/" + line + ".zip") # takes the zip url
+                urls.append(archive + line + ".zip") # takes the zip url
 
     return urls
 
+# functions to download the zips
+
+connections = threading.local() # the HTTP connections of each downloading thread
+
+def get_connection(url):
+    """returns the HTTP connection of the current thread to the server of url,
+    and the path of url on the server.
+    The connection is opened once and then reused for all the downloads of the thread."""
+
+    parts = urllib.parse.urlsplit(url)
+    if not hasattr(connections, 'pool'):
+        connections.pool = {}
+
+    key = (parts.scheme, parts.netloc)
+    if key not in connections.pool:
+        if parts.scheme == 'https':
+            connections.pool[key] = http.client.HTTPSConnection(parts.netloc, timeout=60)
+        else:
+            connections.pool[key] = http.client.HTTPConnection(parts.netloc, timeout=60)
+
+    path = parts.path
+    if parts.query:
+        path += '?' + parts.query
+
+    return connections.pool[key], path
+
+def close_connection(url):
+    """closes the connection of the current thread to the server of url, after an error"""
+    parts = urllib.parse.urlsplit(url)
+    pool = getattr(connections, 'pool', {})
+    connection = pool.pop((parts.scheme, parts.netloc), None)
+    if connection is not None:
+        connection.close()
+
+def request(url, method='GET', headers=None, redirects=5):
+    """sends a request to url with the connection of the current thread (see get_connection),
+    following at most redirects redirections (e. g. from http to https).
+    returns the response (not read yet)"""
+    for hop in range(redirects + 1):
+        try:
+            connection, path = get_connection(url)
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            if response.status not in REDIRECT_STATUS:
+                return response
+            location = response.getheader('Location')
+            response.read() # the connection can only be reused if the answer is read
+        except (OSError, http.client.HTTPException):
+            close_connection(url)
+            raise
+        if location is None:
+            return response
+        url = urllib.parse.urljoin(url, location)
+    raise http.client.HTTPException("too many redirections")
+
+def validator(response):
+    """returns what identifies the version of a file sent by the server (its strong ETag, or else its Last-Modified),
+    for the If-Range header of a resumed download, None if the server gives none"""
+    etag = response.getheader('ETag')
+    if (etag is not None) and not etag.startswith('W/'): # a weak ETag can't be used with If-Range
+        return etag
+    return response.getheader('Last-Modified')
+
+def download(url, zipname, retries=5, backoff=2):
+    """downloads the file at url in zipname.
+    The file is first written in zipname.part. If the download is interrupted, the next try
+    (or the next run of the code) resumes it where it stopped, with an HTTP range request.
+    The range is only sent if the file did not change on the server since the .part was begun
+    (If-Range with the ETag or the date of the file, kept in zipname.part.validator),
+    and the answer must begin where the .part ends, else the file is downloaded again from the beginning.
+    The redirections are followed.
+    If a try fails, the code waits backoff, 2 * backoff, 4 * backoff... seconds before the next one.
+    Only the connection errors, the timeouts and the errors of the server (5xx) are tried again,
+    the other HTTP errors (e. g. 404, the zip does not exist) fail at once.
+
+    returns True if the file was downloaded, False otherwise"""
+
+    part_name = zipname + '.part'
+    validator_name = part_name + '.validator'
+
+    def forget_part():
+        for name in (part_name, validator_name):
+            if os.path.exists(name):
+                os.remove(name)
+
+    for attempt in range(retries + 1):
+        try:
+            with pr.Stage('download') as stage:
+
+                # asking only the end of the file if the beginning is already there, and the file did not change
+                done = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+                headers = {}
+                if (done > 0) and os.path.exists(validator_name):
+                    with open(validator_name, 'r') as f:
+                        headers = {'Range' : 'bytes={}-'.format(done), 'If-Range' : f.read()}
+                response = request(url, 'GET', headers)
+
+                if (response.status == 416) and headers: # the range asked is after the end : the file may be complete
+                    response.read()
+                    if response.getheader('Content-Range') != 'bytes */{}'.format(done):
+                        forget_part()
+                        raise http.client.HTTPException("the partial file does not match the file on the server")
+                else:
+                    if (response.status == 206) and headers: # the server sends the rest of the file
+                        mode = 'ab'
+                        content_range = response.getheader('Content-Range', '')
+                        if content_range.split(' ')[-1].split('-')[0] != str(done):
+                            response.read()
+                            forget_part()
+                            raise http.client.HTTPException("the server did not send the rest of the file ({})".format(content_range))
+                    elif response.status == 200: # the server sends the whole file
+                        mode = 'wb'
+                        done = 0
+                        forget_part()
+                        if validator(response) is not None:
+                            with open(validator_name, 'w') as f:
+                                f.write(validator(response))
+                    else:
+                        response.read() # the connection can only be reused if the answer is read
+                        if (400 <= response.status < 500) and (response.status not in TRANSIENT_STATUS):
+                            print("\nthe downloading of {} failed (HTTP error {} {}), the images within the zipfile won't appear in the final folder".format(url, response.status, response.reason))
+                            return False
+                        raise http.client.HTTPException("HTTP error {} {}".format(response.status, response.reason))
+
+                    length = response.getheader('Content-Length')
+                    with open(part_name, mode) as f:
+                        shutil.copyfileobj(response, f, 2**20)
+                    stage.bytes_written = os.path.getsize(part_name) - done
+
+                    # checking that nothing is missing
+                    if (length is not None) and (os.path.getsize(part_name) != done + int(length)):
+                        raise http.client.IncompleteRead(b'', int(length))
+
+            os.replace(part_name, zipname)
+            forget_part()
+            return True
+
+        except (OSError, http.client.HTTPException) as error:
+            close_connection(url)
+            if attempt == retries:
+                print("\nthe downloading of {} failed ({}), the images within the zipfile won't appear in the final folder".format(url, error))
+                return False
+            wait = backoff * 2**attempt
+            print("\nthe downloading of {} failed ({}), it will begin again in {}s".format(url, error, wait))
+            time.sleep(wait)
+
+def download_all(urls, workers=4, retries=5):
+    """downloads the zips of urls with workers threads, at most workers zips at the same time.
+    It yields (url, zipname, downloaded) in the order of urls, as soon as each zip is there,
+    so that the zips can be extracted while the next ones are downloaded.
+    At most 2 * workers zips are downloaded in advance."""
+
+    queue = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for url in urls:
+            zipname = url.split('/')[-1]
+            queue.append((url, zipname, executor.submit(download, url, zipname, retries)))
+
+            # waits for the oldest zip when enough zips are in advance
+            if len(queue) >= 2 * workers:
+                url, zipname, future = queue.popleft()
+                yield url, zipname, future.result()
+
+        while queue:
+            url, zipname, future = queue.popleft()
+            yield url, zipname, future.result()
+
 def create_coords(ra, dec):
     """creates an object SkyCoord,
     given a right ascension with the string format "HH MM SS.SS"
@@ -73,28 +252,242 @@ def angular_distance_arcmin(coords1, coords2):
     # computes the angular distance
     return (ac.angular_separation(ra1, dec1, ra2, dec2)).to_value(u.arcmin)
 
+def chord_length(angle):
+    """returns the distance between two points of the unit sphere separated by angle (in arcmin)"""
+    return 2 * np.sin(np.radians(angle / 60) / 2)
+
+def unit_vectors(ra, dec):
+    """returns the unit vectors (array of shape (n, 3)) of the directions given
+    by the right ascensions ra and the declinations dec, in degrees"""
+    ra = np.radians(np.atleast_1d(ra))
+    dec = np.radians(np.atleast_1d(dec))
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+class TargetIndex:
+    """spatial index of the targets already seen, to know quickly if a new target
+    is close to one of them.
+
+    The targets are kept as unit vectors in a grid of cubic cells, whose side is the chord
+    of the threshold angle. A target can only be closer than the threshold to the targets
+    of the cells around its own cell, so a query compares it to a few targets only,
+    whatever the number of targets seen."""
+
+    def __init__(self, threshold = 2):
+        self.cell_size = chord_length(threshold) # threshold in arcmin
+        self.cells = {}
+        self.n_targets = 0
+
+    def __len__(self):
+        return self.n_targets
+
+    def cell(self, vector):
+        """returns the cell of a unit vector"""
+        return tuple(np.floor(vector / self.cell_size).astype(int))
+
+    def add_many(self, ra, dec):
+        """adds several targets at once, given their right ascensions and declinations in degrees"""
+        for vector in unit_vectors(ra, dec):
+            self.cells.setdefault(self.cell(vector), []).append(vector)
+            self.n_targets += 1
+
+    def add(self, target):
+        """adds a target (SkyCoord object)"""
+        self.add_many(target.ra.deg, target.dec.deg)
+
+    def is_close(self, target, threshold = 2):
+        """returns True if a target already seen is at an angular distance inferior to threshold (in arcmin)
+        from the target (SkyCoord object)"""
+
+        vector = unit_vectors(target.ra.deg, target.dec.deg)[0]
+        chord = chord_length(threshold)
+        cell = self.cell(vector)
+        reach = int(np.ceil(chord / self.cell_size)) # number of cells to look at on each side
+
+        # gathering the targets of the cells around the cell of the target
+        neighbours = []
+        for shift in itertools.product(range(-reach, reach + 1), repeat=3):
+            neighbours += self.cells.get((cell[0] + shift[0], cell[1] + shift[1], cell[2] + shift[2]), [])
+        if len(neighbours) == 0:
+            return False
+
+        distances = np.linalg.norm(np.array(neighbours) - vector, axis=1)
+        return bool(np.any(distances < chord))
+
 def check_distances(target, coord_list, threshold = 2):
     """verify that the target (target is a SkyCoord object) is at
     an angular distance superior to threshold (in arcmin) from all the targets 
-    in coord_list.
+    in coord_list (a TargetIndex).
     If that is the case, returns True and add the target to coord_list. 
     If that is not the case, returns False."""
     
-    check = True
-
     # checks the distances
-    for coord in coord_list:
-        ang_d = angular_distance_arcmin(target, coord)
-        if ang_d < threshold:
-            check = False
+    check = not coord_list.is_close(target, threshold)
 
-    # appends the target to the list if check is True
+    # adds the target to the index if check is True
     if check == True :
-        coord_list.append(target)
+        coord_list.add(target)
 
     return check, coord_list   
     
-def gather_images(date1, date2, band, folder_name, shape, ft):
+# functions to select the images directly in the zips
+
+def read_member_header(zip, member):
+    """reads only the header of a .fits file inside a zip, block of 2880 bytes by block,
+    without extracting the file. returns None if the file ends before the END card."""
+
+    blocks = []
+    with zip.open(member) as f:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                return None
+            blocks.append(block)
+
+            # the header ends with the END card, cards are 80 characters long
+            if any(block[i:i + 80].rstrip() == b'END' for i in range(0, 2880, 80)):
+                break
+
+    return fits.Header.fromstring(b''.join(blocks).decode('ascii'))
+
+def check_header(header, shape, ft, seen_list):
+    """checks all the conditions on the header of an image :
+    its shape, its calibration, and if ft, the distance of its target to the targets already seen.
+    returns True if the image is wanted"""
+
+    # checking the shape of the image
+    s1 = header['NAXIS1']
+    s2 = header['NAXIS2']
+
+    if (s1, s2) != shape: # condition on the size of the image
+        return False
+    
+    if 'HISTORY' in header: # condition on the calibration of the image, which can be found in the header's history
+        history = header['HISTORY']
+        history = str(history)
+        bias = ('Bias' in history)
+        dark = ('Dark' in history)
+        flat = ('Flat' in history)
+        if not (dark and bias and flat):
+            return False
+    else:
+        return False
+
+    if ft and ('OBJCTRA' in header) and ('OBJCTDEC' in header): # checking if it is the first time the target of the image is seen in the zip
+        # takes the coordinates of the target
+        ra = header['OBJCTRA']
+        dec = header['OBJCTDEC']
+        target = create_coords(ra, dec)
+        check_target, seen_list = check_distances(target, seen_list)
+        if not check_target:
+            return False
+
+    return True
+
+def extract_zip(zipname, band, folder_name, shape, ft, seen_list):
+    """extracts in folder_name only the images of the zip which pass all the checks.
+    The names of the files are checked first, then only the header of each remaining image is read
+    from the zip. The images which pass all the checks are written directly in folder_name.
+
+    returns the names of the images which passed all the checks (extracted now or already in folder_name),
+    and the coordinates [ra, dec] (in degrees) of their targets"""
+
+    frames = []
+    targets = []
+
+    with ZipFile(zipname, 'r') as zip:
+        for member in zip.infolist():
+            image = member.filename
+            
+            # checking all conditions on the names of the images
+
+            if member.is_dir():
+                continue
+            if ".fits" not in image: # verify the extension
+                continue
+            if ("_" + band) not in image: # the condition to select the correct band 
+                continue
+            if "RAW" in image: # we don't want raw images
+                continue
+
+            # checking the conditions on the header, without extracting the image
+            with pr.Stage('header filtering') as stage:
+                header = read_member_header(zip, member)
+                wanted = (header is not None) and check_header(header, shape, ft, seen_list)
+                if header is not None:
+                    stage.bytes_read = 2880 * (len(header) // 36 + 1) # the blocks of the header
+            if not wanted:
+                continue
+
+            # if all the previous checks are passed, extracting the image
+            # it is written in a temporary file first, so that an interrupted extraction leaves no broken image
+            image_name = os.path.basename(image)
+            dir = os.path.join(folder_name, image_name)
+            if not os.path.exists(dir):
+                with pr.Stage('extraction') as stage:
+                    with zip.open(member) as source, open(dir + '.tmp', 'wb') as target:
+                        shutil.copyfileobj(source, target, 2**20)
+                    os.replace(dir + '.tmp', dir)
+                    stage.bytes_read = member.compress_size
+                    stage.bytes_written = member.file_size
+
+                # the header is already read, it goes directly in the catalogue of the folder
+                hi.record_header(folder_name, dir, header)
+
+            frames.append(image_name)
+            if ('OBJCTRA' in header) and ('OBJCTDEC' in header):
+                coords = create_coords(header['OBJCTRA'], header['OBJCTDEC'])
+                targets.append([coords.ra.deg, coords.dec.deg])
+
+    return frames, targets
+
+# functions to keep a manifest of the zips already processed
+
+def remote_info(url):
+    """asks the server the size and the ETag of a file, without downloading it (HEAD request).
+    returns (None, None) if the server does not answer"""
+    try:
+        response = request(url, 'HEAD')
+        response.read()
+        if response.status != 200:
+            return None, None
+        size = response.getheader('Content-Length')
+        if size is not None:
+            size = int(size)
+        return size, response.getheader('ETag')
+    except (OSError, http.client.HTTPException):
+        close_connection(url)
+        return None, None
+
+def read_manifest(folder_name, selection):
+    """reads the manifest of folder_name (folder_name/manifest.json), which records for each zip already
+    processed its size, its ETag, the images kept and their targets.
+    If the images were selected with other parameters (selection), the manifest is not used."""
+    manifest_name = os.path.join(folder_name, 'manifest.json')
+    if os.path.exists(manifest_name):
+        with open(manifest_name, 'r') as f:
+            manifest = json.load(f)
+        if manifest['selection'] == selection:
+            return manifest
+        print("the selection changed since the last run, all the zips will be processed again")
+    return {'selection' : selection, 'archives' : {}}
+
+def write_manifest(folder_name, manifest):
+    """writes the manifest of folder_name, safely (temporary file then renaming)"""
+    manifest_name = os.path.join(folder_name, 'manifest.json')
+    with open(manifest_name + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_name + '.tmp', manifest_name)
+
+def up_to_date(entry, size, etag, folder_name):
+    """checks if a zip recorded in the manifest (entry) has not changed on the server
+    (same size, same ETag) and if all its images are still in folder_name"""
+    if (entry is None) or (size is None and etag is None):
+        return False
+    if (entry['size'] != size) or (entry['etag'] != etag):
+        return False
+    return all(os.path.exists(os.path.join(folder_name, name)) for name in entry['frames'])
+
+def gather_images(date1, date2, band, folder_name, shape, ft, workers=4, retries=5, url=INDEX_URL, archive=ARCHIVE_URL, sync=True):
     """Gather all the images of IRiS in a given band,
     between date1 and date2 (date1 <= date2).
     Plus, we only keep the images with a given shape.
@@ -104,6 +497,12 @@ def gather_images(date1, date2, band, folder_name, shape, ft):
     The images are saved in a folder, given by folder_name.
     finally, the argument ft is used to indicate if we want only target that
      are far from each other (>2 arcmin) (ft = True), or not (ft = False)
+
+    workers : number of zips downloaded at the same time, while the previous zips are extracted.
+    retries : number of new tries when a download fails.
+    url, archive : the page listing the observations, and the beginning of the zip URLs.
+    sync : if True, the zips already processed in a previous run (recorded in folder_name/manifest.json)
+    are only downloaded again if they changed on the server.
     """
 
     t0 = int(time.time()) # to print the time of extraction at the end
@@ -119,104 +518,53 @@ def gather_images(date1, date2, band, folder_name, shape, ft):
     if not os.path.exists(folder_name):
         os.mkdir(folder_name)
 
-    # creation of a temporary file where the zips are extracted
-    tmp_path = "tmp"
-    if not os.path.exists(tmp_path):
-        os.mkdir(tmp_path)
-
-    urls = gather_url(date1, date2) # gets the zip urls
+    urls = gather_url(date1, date2, url, archive) # gets the zip urls
 
     print("sorting image of {}-band : {} zips".format(band, len(urls)))
 
-    seen_list = [] # memorize the targets seen, for ft
+    seen_list = TargetIndex() # memorize the targets seen, for ft
 
-    # processing all zip urls
-    for url in urls:
+    if sync:
+        manifest = read_manifest(folder_name, {'band' : band, 'shape' : list(shape), 'far target' : ft})
 
-        zipname = url.strip("http://iris.lam.fr/observations/").strip(".zip") + ".zip"
+        # asking the size and the ETag of all the zips
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            infos = dict(zip(urls, executor.map(remote_info, urls)))
+
+        # the zips which did not change are not downloaded again, but their targets are still seen
+        to_download = []
+        for zip_url in urls:
+            entry = manifest['archives'].get(zip_url)
+            if up_to_date(entry, infos[zip_url][0], infos[zip_url][1], folder_name):
+                if len(entry['targets']) > 0:
+                    targets = np.array(entry['targets'])
+                    seen_list.add_many(targets[:, 0], targets[:, 1])
+            else:
+                to_download.append(zip_url)
+        print("{} zips already up to date, {} zips to download".format(len(urls) - len(to_download), len(to_download)))
+        urls = to_download
+
+    # processing all zip urls, the next zips are downloaded while a zip is extracted
+    for zip_url, zipname, downloaded in download_all(urls, workers, retries):
+
+        if not downloaded: # the message was already displayed
+            continue
         print("\nextracting file : {}".format(zipname))
 
-        # downloading the zipfile 
+        # extracting only the images wanted, and deleting the zip
         try:
-            wget.download(url, zipname)
-        except (HTTPError, ContentTooShortError):
-            print("\nthe first downloading failed, it will begin again in 5s")
-            try:
-                time.sleep(5)
-                wget.download(url, zipname)
-            except (HTTPError, ContentTooShortError):
-                print("\nthe downloading failed again, the images within the zipfile won't appear in the final folder")
-
-        # extracting the zip and deleting it
-        try:
-            with ZipFile(zipname, 'r') as zip:
-                zip.extractall("tmp")
+            frames, targets = extract_zip(zipname, band, folder_name, shape, ft, seen_list)
+
+            # recording the zip in the manifest, after each zip so that an interrupted run is not lost
+            if sync:
+                manifest['archives'][zip_url] = {'size' : os.path.getsize(zipname), 'etag' : infos[zip_url][1],
+                                                 'frames' : frames, 'targets' : targets}
+                write_manifest(folder_name, manifest)
         except BadZipFile: # in case theres is a problem while downloading the file
             print("\nthe file {} was not correctly downloaded. Its images won't appear in the final folder".format(zipname))
         
         os.remove(zipname)
 
-        images = glob.glob(tmp_path + "\\*") # gets all the images in the temporary file
-        
-        # getting only the images wanted
-        for image in images:
-            
-            # checking all conditions on the images
-
-            if ".fits" not in image: # verify the extension
-                continue
-            if ("_" + band) not in image: # the condition to select the correct band 
-                continue
-            if "RAW" in image: # we don't want raw images
-                continue
-
-            with fits.open(image) as f:
-                header = f[0].header
-
-            # checking the shape of the image
-            s1 = header['NAXIS1']
-            s2 = header['NAXIS2']
-
-            if (s1, s2) != shape: # condition on the size of the image
-                continue
-            
-            if 'HISTORY' in header: # condition on the calibration of the image, which can be found in the header's history
-                history = header['HISTORY']
-                history = str(history)
-                bias = ('Bias' in history)
-                dark = ('Dark' in history)
-                flat = ('Flat' in history)
-                if not (dark and bias and flat):
-                    continue
-            else:
-                continue
-
-            if ft and ('OBJCTRA' in header) and ('OBJCTDEC' in header): # checking if it is the first time the target of the image is seen in the zip
-                # takes the coordinates of the target
-                ra = header['OBJCTRA']
-                dec = header['OBJCTDEC']
-                target = create_coords(ra, dec)
-                check_target, seen_list = check_distances(target, seen_list)
-                if not check_target:
-                    continue
-
-            # if all the previous checks are passed, moving the image
-            image_name = image.split(tmp_path + "\\")[-1]
-            dir = folder_name + "\\" + image_name
-            if not os.path.exists(dir):
-                shutil.move(image, dir)
-
-        # removes what's inside the temporary folder                    
-        to_remove = glob.glob(tmp_path + "\\*.fits")
-        for im in to_remove:
-            os.remove(im)
-        # removes the temporary files that could have been created during the extraction of the zip
-        remove_tmp = glob.glob("*.tmp")
-        for tmp in remove_tmp:
-            os.remove(tmp)
-    
-    os.rmdir(tmp_path)
-
     t = int(time.time() - t0)
 
     print("\nextraction done in {} min {} s".format(t // 60, t % 60))
@@ -253,6 +601,10 @@ def read_shape(shape):
     shape = (s1, s2)
     return shape
 
+def read_int(num):
+    """convert a string into an int"""
+    return int(num)
+
 def read_bool(bool):
     """reads a string bollean and returns the boolean associated"""
     if bool == "True" or bool == "true":
@@ -278,9 +630,14 @@ def read_setup(file, verbose):
     folder_name = "iris_{}_band_{}_{}".format(band, beg_date, end_date)
     shape = (2048, 2048)
     ft = True
+    workers = 4
+    retries = 5
+    url = INDEX_URL
+    archive = ARCHIVE_URL
+    sync = True
 
     # list of the default parameters
-    param_list = [band, beg_date, end_date, folder_name, shape, ft]
+    param_list = [band, beg_date, end_date, folder_name, shape, ft, workers, retries, url, archive, sync]
 
     # displays the default values if verbose
     if verbose:
@@ -291,10 +648,16 @@ def read_setup(file, verbose):
         print("- folder_name : iris_{band}_band_{beginning_date}_{ending_date}")
         print("- image shape : {}".format(shape))
         print("- far target : {}".format(ft))
+        print("- download workers : {}".format(workers))
+        print("- retries : {}".format(retries))
+        print("- index url : {}".format(url))
+        print("- archive url : {}".format(archive))
+        print("- sync : {}".format(sync))
         print("\na message will be displayed each time a value is modified\n")
 
     # list of all the parameters accepted by the code
-    input_list = ['band', 'beg date', 'end date', 'folder name', 'image shape', 'far target']
+    input_list = ['band', 'beg date', 'end date', 'folder name', 'image shape', 'far target',
+                  'download workers', 'retries', 'index url', 'archive url', 'sync']
 
     # dictionnary with a function associated to each parameter if necessary to read them correctly
     input_dic = {'band' : do_nothing,
@@ -302,7 +665,12 @@ def read_setup(file, verbose):
                  'end date' : read_date,
                  'folder name' : do_nothing,
                  'image shape' : read_shape,
-                 'far target' : read_bool}
+                 'far target' : read_bool,
+                 'download workers' : read_int,
+                 'retries' : read_int,
+                 'index url' : do_nothing,
+                 'archive url' : do_nothing,
+                 'sync' : read_bool}
 
     # control of the explicit modification of the folder name
     folder_check = False
@@ -349,12 +717,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help="setup file needed to execute the code")
     parser.add_argument('-v', '--verbose', help="gives more information", action="store_true")
+    pr.add_arguments(parser)
     args = parser.parse_args()
     f_name = args.file
     verbose = args.verbose
+    pr.start(args.profile, args.cprofile, args.tracemalloc)
 
     # reading the setup file
-    band, beg_date, end_date, folder_name, shape, ft = read_setup(f_name, verbose)
+    band, beg_date, end_date, folder_name, shape, ft, workers, retries, url, archive, sync = read_setup(f_name, verbose)
 
     # gathering the images
-    gather_images(beg_date, end_date, band, folder_name, shape, ft)
\ No newline at end of file
+    gather_images(beg_date, end_date, band, folder_name, shape, ft, workers, retries, url, archive, sync)
\ No newline at end of file
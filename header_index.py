@@ -0,0 +1,256 @@
+# !/usr/bin/env python
+
+import os
+import glob
+import hashlib
+import sqlite3
+import numpy as np
+from astropy.io import fits
+import astropy.coordinates as ac
+from astropy import units as u
+
+"""Keeps a catalogue of the headers of the images of a folder (folder/headers.sqlite),
+so that the codes do not have to open the .fits files only to read their headers.
+The catalogue is updated incrementally: only the new or modified files (size, modification time) are read.
+The catalogues can be kept in another folder (see set_index_folder), e. g. on a local disk when the images are on NFS,
+and when the catalogue cannot be written (read-only folder, catalogue locked by another run), it is kept in memory for the run."""
+
+# the columns of the catalogue, after the name, the size and the modification time of the file
+COLUMNS = ['naxis1', 'naxis2', 'band', 'pierside', 'date_obs', 'objctra', 'objctdec', 'ra', 'dec', 'calibrated']
+
+# the folder where the catalogues are kept, None to keep each one in the folder of its images
+index_folder = None
+
+# the catalogues kept in memory, for the folders whose catalogue cannot be written: a connection is kept open
+# for each one, so that the catalogue lives until the end of the run
+memory_indexes = {}
+
+def set_index_folder(folder):
+    """keeps the catalogues of the next folders in folder (created if needed) instead of the folders of the images"""
+    global index_folder
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+    index_folder = folder
+
+def index_name(folder):
+    """gives the name of the catalogue of a folder: folder/headers.sqlite, or a file named after the path of the folder
+    in the folder of the catalogues"""
+    if index_folder is None:
+        return os.path.join(folder, 'headers.sqlite')
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return os.path.join(index_folder, 'headers_{}_{}.sqlite'.format(os.path.basename(os.path.abspath(folder)), key))
+
+def can_write(file_name):
+    """tells if the catalogue file_name can be written (sqlite also writes its journal next to it)"""
+    if not os.access(os.path.dirname(file_name) or '.', os.W_OK):
+        return False
+    return (not os.path.exists(file_name)) or os.access(file_name, os.W_OK)
+
+def create_table(connection):
+    """creates the table of the catalogue if needed"""
+    connection.execute("""CREATE TABLE IF NOT EXISTS images (
+                          name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+                          naxis1 INTEGER, naxis2 INTEGER, band TEXT, pierside TEXT, date_obs TEXT,
+                          objctra TEXT, objctdec TEXT, ra REAL, dec REAL, calibrated INTEGER)""")
+
+def memory_uri(folder):
+    """gives the name of the catalogue of a folder kept in memory, shared by the connections of the process"""
+    return 'file:headers_{}?mode=memory&cache=shared'.format(hashlib.sha1(os.path.abspath(folder).encode()).hexdigest())
+
+def use_memory(folder):
+    """keeps the catalogue of folder in memory for the run, starting from the catalogue on the disk if it can be read"""
+    name = index_name(folder)
+    print("the catalogue {} cannot be written, the headers of {} are read and kept in memory".format(name, folder))
+    connection = sqlite3.connect(memory_uri(folder), uri=True)
+    create_table(connection)
+    if os.path.exists(name):
+        try:
+            disk = sqlite3.connect('file:{}?mode=ro'.format(name), uri=True)
+            rows = disk.execute("SELECT * FROM images").fetchall()
+            disk.close()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO images VALUES ({})".format(', '.join(['?'] * 13)), rows)
+        except sqlite3.Error: # the headers are read again
+            pass
+    memory_indexes[os.path.abspath(folder)] = connection
+
+def open_index(folder):
+    """opens (and creates if needed) the catalogue of the headers of a folder,
+    kept in memory if it cannot be written"""
+    if (os.path.abspath(folder) not in memory_indexes) and not can_write(index_name(folder)):
+        use_memory(folder)
+    if os.path.abspath(folder) in memory_indexes:
+        return sqlite3.connect(memory_uri(folder), uri=True)
+    connection = sqlite3.connect(index_name(folder))
+    try:
+        create_table(connection)
+    except sqlite3.OperationalError: # read-only file system, catalogue locked by another run...
+        connection.close()
+        use_memory(folder)
+        return sqlite3.connect(memory_uri(folder), uri=True)
+    return connection
+
+def band_of(image_name):
+    """gives the band of an image from its name, e. g. 'i' for m_81-S001-R001-C001-SDSS_i.fits"""
+    return os.path.basename(image_name).split('.fits')[0].split('_')[-1]
+
+def header_row(image_name, header, signature):
+    """gives the line of the catalogue of an image, given its header and its signature (size, modification time)"""
+
+    # condition on the calibration of the image, which can be found in the header's history
+    history = str(header['HISTORY']) if 'HISTORY' in header else ''
+    calibrated = ('Bias' in history) and ('Dark' in history) and ('Flat' in history)
+
+    # coordinates of the target in degrees, to select the images around a target (None if they cannot be read)
+    ra, dec = None, None
+    if ('OBJCTRA' in header) and ('OBJCTDEC' in header):
+        try:
+            coords = ac.SkyCoord(header['OBJCTRA'] + ' ' + header['OBJCTDEC'], unit=(u.hourangle, u.deg))
+            ra, dec = float(coords.ra.deg), float(coords.dec.deg)
+        except (ValueError, TypeError):
+            print("the coordinates of {} cannot be read : {} {}".format(image_name, header['OBJCTRA'], header['OBJCTDEC']))
+
+    pierside = header['PIERSIDE'].strip() if 'PIERSIDE' in header else None
+
+    return (os.path.basename(image_name), signature[0], signature[1],
+            header.get('NAXIS1'), header.get('NAXIS2'), band_of(image_name), pierside, header.get('DATE-OBS'),
+            header.get('OBJCTRA'), header.get('OBJCTDEC'), ra, dec, int(calibrated))
+
+def file_signature(file_name):
+    """returns the size and the modification time of a file"""
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def record_header(folder, image_name, header):
+    """records in the catalogue of folder the header of an image already read elsewhere
+    (e. g. while extracting it from a zip), so that it is not read again"""
+    connection = open_index(folder)
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO images VALUES ({})".format(', '.join(['?'] * 13)),
+                           header_row(image_name, header, file_signature(image_name)))
+    connection.close()
+
+def update_index(folder):
+    """updates the catalogue of folder: reads the headers of the new or modified images only,
+    and forgets the images which are not in the folder anymore.
+    returns the number of headers read"""
+
+    connection = open_index(folder)
+    known = {name : [size, mtime] for name, size, mtime in connection.execute("SELECT name, size, mtime FROM images")}
+
+    images = glob.glob(os.path.join(folder, '*.fits'))
+    names = set()
+    rows = []
+    for image in images:
+        name = os.path.basename(image)
+        names.add(name)
+        signature = file_signature(image)
+        if known.get(name) != signature:
+            rows.append(header_row(image, fits.getheader(image), signature))
+
+    try:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO images VALUES ({})".format(', '.join(['?'] * 13)), rows)
+            connection.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in known if name not in names])
+    except sqlite3.OperationalError: # read-only file system, catalogue locked by another run...
+        connection.close()
+        if os.path.abspath(folder) in memory_indexes:
+            raise
+        use_memory(folder)
+        return update_index(folder)
+    connection.close()
+
+    return len(rows)
+
+def header_info(folder, image_name):
+    """returns the line of the catalogue of an image as a dictionary, or None if the image is not in it"""
+    connection = open_index(folder)
+    row = connection.execute("SELECT {} FROM images WHERE name = ?".format(', '.join(COLUMNS)),
+                             (os.path.basename(image_name),)).fetchone()
+    connection.close()
+    if row is None:
+        return None
+    return dict(zip(COLUMNS, row))
+
+def images_summary(folder, images):
+    """returns the bands of the images of the list images (found in the catalogue of folder),
+    and their first and last DATE-OBS (None if no image has one)"""
+    names = [os.path.basename(image_name) for image_name in images]
+    bands = set()
+    dates = []
+    connection = open_index(folder)
+    for first in range(0, len(names), 500): # sqlite limits the number of values of a query
+        chunk = names[first:first + 500]
+        query = "SELECT band, date_obs FROM images WHERE name IN ({})".format(', '.join(['?'] * len(chunk)))
+        for band, date_obs in connection.execute(query, chunk):
+            bands.add(band)
+            if date_obs is not None:
+                dates.append(date_obs)
+    connection.close()
+    if len(dates) == 0:
+        return sorted(bands), None, None
+    return sorted(bands), min(dates), max(dates)
+
+def read_date(date):
+    """converts a date YYYYMMDD (int) into the string YYYY-MM-DD used in DATE-OBS"""
+    date = str(date)
+    return '{}-{}-{}'.format(date[:4], date[4:6], date[6:8])
+
+def select_images(folder, band=None, pierside=None, date1=None, date2=None, shape=None, calibrated=None,
+                  target=None, radius=2, update=True):
+    """returns the names of the images of folder which match all the conditions given, using the catalogue.
+
+    band : e. g. 'i'. pierside : 'EAST' or 'WEST'.
+    date1, date2 : the images observed between date1 and date2 (int YYYYMMDD, included).
+    shape : (NAXIS1, NAXIS2). calibrated : True for the images with Bias, Dark and Flat in their history.
+    target : (ra, dec) in degrees, with radius in arcmin, the images of the targets around it.
+    update : if True, the catalogue is updated first."""
+
+    if update:
+        update_index(folder)
+
+    conditions = []
+    values = []
+    if band is not None:
+        conditions.append("band = ?")
+        values.append(band)
+    if pierside is not None:
+        conditions.append("pierside = ?")
+        values.append(pierside)
+    if date1 is not None:
+        conditions.append("substr(date_obs, 1, 10) >= ?")
+        values.append(read_date(date1))
+    if date2 is not None:
+        conditions.append("substr(date_obs, 1, 10) <= ?")
+        values.append(read_date(date2))
+    if shape is not None:
+        conditions.append("naxis1 = ? AND naxis2 = ?")
+        values += [shape[0], shape[1]]
+    if calibrated is not None:
+        conditions.append("calibrated = ?")
+        values.append(int(calibrated))
+    if target is not None: # first, a band of declination around the target
+        conditions.append("dec BETWEEN ? AND ?")
+        values += [target[1] - radius / 60, target[1] + radius / 60]
+
+    query = "SELECT name, ra, dec FROM images"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY name"
+
+    connection = open_index(folder)
+    rows = connection.execute(query, values).fetchall()
+    connection.close()
+
+    if target is not None and len(rows) > 0: # then the exact angular distance
+        ra = np.radians([row[1] for row in rows])
+        dec = np.radians([row[2] for row in rows])
+        ra0, dec0 = np.radians(target[0]), np.radians(target[1])
+        cos_d = np.sin(dec) * np.sin(dec0) + np.cos(dec) * np.cos(dec0) * np.cos(ra - ra0)
+        distance = np.degrees(np.arccos(np.clip(cos_d, -1, 1))) * 60
+        rows = [row for row, d in zip(rows, distance) if d < radius]
+
+    return [os.path.join(folder, row[0]) for row in rows]
+
+if __name__ == "__main__":
+    pass
@@ -1,23 +1,41 @@
 #!/usr/bin/env python
 
 import utils as ut
+import profiling as pr
 import numpy as np
 import argparse
 import os
 import glob
+import json
 import datetime
 from astropy.io import fits
 import version as v
-import shutil
+import header_index as hi
 
 """Creates a fringe_model to use in order to suppress fringing on IRiS images.
 To create the model, we use the method of Snodgrass & Carry 2013, Messenger 152, 14"""
 
-def create_model(fringe_maps, model_name, folder, N_samples):
-    """create the fringe model and save it with the model_name"""
+def create_model(fringe_maps, model_name, folder, N_samples, memory=None, dtype=np.float32, selection=None, bins=None, binning=1,
+                 summary=None):
+    """create the fringe model and save it with the model_name
+    if memory (in MB) is given, the median is done band by band
+    the model is saved with the type dtype
+    selection : the conditions on the images of the folder used (see header_index.select_images),
+    the band and the dates of these images are written in the header of the model (FILTER, DATE-BEG, DATE-END)
+    so that remove_fringing.py can choose the model in a library of models
+    bins : if given, the median is approximated with a histogram of bins bins (see utils.StreamingMedian),
+    fringe_maps can then be the StreamingMedian returned by utils.gather_normalized_images
+    binning : the binning of the images of the fringe maps, written in the header (BINNING) of a preview model,
+    which remove_fringing.py expands back to the full resolution
+    summary : the bands and the dates of the images used (see header_index.images_summary), if they are already known
+    (e. g. by the reduction of shards, which does not need to see the folder). Else they are read in the catalogue of folder"""
 
     # creates the model by taking the median of all fringe_maps
-    median = np.median(fringe_maps, axis = 0)
+    with pr.Stage('final combine'):
+        median = ut.median_combine(fringe_maps, memory, bins)
+        median = median.astype(dtype, copy=False)
+    if isinstance(fringe_maps, ut.StreamingMedian) and (fringe_maps.n_outside > 0):
+        print("{} pixels of the model are at the edge of their histogram".format(fringe_maps.n_outside))
 
     # creating the header with the history of the processing
     hdu = fits.PrimaryHDU()
@@ -25,9 +43,115 @@ def create_model(fringe_maps, model_name, folder, N_samples):
     header['HISTORY'] = "model done with model.py (version {})".format(v.version_model())
     header['HISTORY'] = 'using the image folder {}'.format(folder)
     header['HISTORY'] = 'with {} image samples'.format(N_samples)
+    if bins is not None:
+        header['HISTORY'] = 'approximate median of the samples, histograms of {} bins'.format(bins)
+    if binning > 1:
+        header['HISTORY'] = 'preview model, the images were binned {0}x{0}'.format(binning)
+        header['BINNING'] = (binning, 'binning of the images of the model')
+
+    # the band and the dates of the images used
+    if summary is None:
+        if selection is None:
+            selection = {}
+        summary = hi.images_summary(folder, hi.select_images(folder, update=False, **selection))
+    bands, date1, date2 = summary
+    if len(bands) == 1:
+        header['FILTER'] = (bands[0], 'band of the images of the model')
+    if date1 is not None:
+        header['DATE-BEG'] = (date1, 'first observation used for the model')
+        header['DATE-END'] = (date2, 'last observation used for the model')
     
     # creates a .fits file to save the model
-    ut.create_fits(model_name, median, header)
+    with pr.Stage('write') as stage:
+        ut.create_fits(model_name, median, header)
+        stage.bytes_written = pr.file_size(model_name)
+
+# functions to make the model in several shards (map), possibly on several machines, and then combine them (reduce).
+# The shards only share a folder: each shard writes its fringe maps there, and the reduction reads them all
+
+def read_shard(text):
+    """reads a shard given as index/number, e. g. 2/8 for the third shard of 8 (the indices start at 0)"""
+    index, n_shards = [int(x) for x in text.split('/')]
+    if not 0 <= index < n_shards:
+        raise argparse.ArgumentTypeError("the index of the shard must be between 0 and the number of shards - 1")
+    return index, n_shards
+
+def shard_names(shard_folder, shard):
+    """gives the names of the fringe maps (.npy) and of the information (.json) of a shard"""
+    name = os.path.join(shard_folder, 'shard_{}_of_{}'.format(shard[0], shard[1]))
+    return name + '.npy', name + '.json'
+
+def write_shard(fringe_maps, shard_folder, shard, parameters):
+    """writes the fringe maps made by a shard in shard_folder, with the information needed by the reduction:
+    the shard, the ids of its samples (see utils.shard_samples) and the parameters of the model (with the folder,
+    the bands and the dates of the images, so that the reduction does not need to see the folder), which must be
+    the same for all the shards. The information is written last, once the fringe maps are complete,
+    so that a shard is done when its .json file exists"""
+
+    if not os.path.exists(shard_folder):
+        os.makedirs(shard_folder, exist_ok=True) # the shards can create it at the same time
+    maps_name, info_name = shard_names(shard_folder, shard)
+    n_maps = len(fringe_maps)
+
+    with pr.Stage('write') as stage:
+        if n_maps > 0:
+            out = np.lib.format.open_memmap(maps_name + '.tmp', mode='w+', dtype=fringe_maps[0].dtype,
+                                            shape=(n_maps,) + fringe_maps[0].shape)
+            for i in range(n_maps): # one map at a time, the fringe maps can be memory-mapped
+                out[i] = fringe_maps[i]
+            out.flush()
+            del out
+            os.replace(maps_name + '.tmp', maps_name)
+            stage.bytes_written = pr.file_size(maps_name)
+
+        info = dict(parameters)
+        info['shard'] = list(shard)
+        info['samples'] = ut.shard_samples(parameters['N_samples'], shard)
+        with open(info_name + '.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(info_name + '.tmp', info_name)
+
+def read_shards(shard_folder):
+    """reads the fringe maps written by all the shards in shard_folder (memory-mapped), checking
+    that all the shards are done and were made with the same parameters. Exits if it is not the case.
+
+    returns the fringe maps of all the samples, in the order of their ids, their number
+    and the parameters of the model agreed by all the shards (see write_shard)"""
+
+    infos = {}
+    for info_name in glob.glob(os.path.join(shard_folder, 'shard_*_of_*.json')):
+        with open(info_name, 'r') as f:
+            info = json.load(f)
+        infos[tuple(info['shard'])] = info
+    if len(infos) == 0:
+        print("NO SHARD FOUND IN {}".format(shard_folder))
+        exit()
+
+    numbers = {n_shards for index, n_shards in infos}
+    if len(numbers) > 1:
+        print("the folder {} has shards of runs with different numbers of shards ({})".format(shard_folder, sorted(numbers)))
+        exit()
+    n_shards = numbers.pop()
+    missing = [index for index in range(n_shards) if (index, n_shards) not in infos]
+    if len(missing) > 0:
+        print("the shards {} of {} are not done yet".format(missing, n_shards))
+        exit()
+
+    parameters = [{key : value for key, value in info.items() if key not in ('shard', 'samples')} for info in infos.values()]
+    if any(p != parameters[0] for p in parameters):
+        print("the shards were not made with the same setup")
+        exit()
+
+    maps = {}
+    for shard, info in infos.items():
+        if len(info['samples']) == 0: # more shards than samples
+            continue
+        shard_maps = np.load(shard_names(shard_folder, shard)[0], mmap_mode='r')
+        for i, id_sample in enumerate(info['samples']):
+            maps[id_sample] = shard_maps[i]
+    fringe_maps = [maps[id_sample] for id_sample in sorted(maps)]
+
+    return fringe_maps, len(fringe_maps), parameters[0]
 
 # functions to correctly read the setup file
 
@@ -48,6 +172,17 @@ def read_int(num):
     """convert a string into an int"""
     return int(num)
 
+def read_float(num):
+    """convert a string into a float"""
+    return float(num)
+
+def read_date(date):
+    """reads a string date with the format "YYYY/MM/DD"
+    and returns an int associated with the format YYYYMMDD"""
+    date = date.split('/')
+    date = int(''.join(date))
+    return date
+
 def do_nothing(x):
     """just a convenient function for after"""
     return x
@@ -68,10 +203,28 @@ def read_setup(file, verbose):
     # setting the default parameters
     image_folder = None
     N_samples = None
+    memory = None
+    workers = 1
+    seed = None
+    store = None
+    dtype = np.dtype(np.float32)
+    band = None
+    beg_date = None
+    end_date = None
     model_name = "iris_model_{}-{:02d}-{:02d}_{:02d}-{:02d}-{:02d}.fits".format(year, month, day, hour, minute, sec)
 
     # list of the default parameters
-    param_list = [image_folder, N_samples, model_name]
+    read_ahead = 2
+    sky = 'median'
+    bins = None
+    checkpoint = None
+    shard_folder = None
+    tolerance = None
+    step = 10
+    binning = 1
+    index_folder = None
+    param_list = [image_folder, N_samples, model_name, memory, workers, seed, store, dtype, band, beg_date, end_date, read_ahead, sky,
+                  bins, checkpoint, shard_folder, tolerance, step, binning, index_folder]
 
     # displays the default values if verbose
     if verbose:
@@ -79,15 +232,51 @@ def read_setup(file, verbose):
         print("- image folder : {}".format(image_folder))
         print("- number of samples : {}".format(N_samples))
         print("- model name : {}".format(model_name))
+        print("- memory budget : {}".format(memory))
+        print("- number of workers : {}".format(workers))
+        print("- seed : {}".format(seed))
+        print("- model store : {}".format(store))
+        print("- dtype : {}".format(dtype))
+        print("- band : {}".format(band))
+        print("- beginning date : {}".format(beg_date))
+        print("- ending date : {}".format(end_date))
+        print("- read ahead : {}".format(read_ahead))
+        print("- sky estimator : {}".format(sky))
+        print("- streaming bins : {}".format(bins))
+        print("- checkpoint : {}".format(checkpoint))
+        print("- shard folder : {}".format(shard_folder))
+        print("- convergence tolerance : {}".format(tolerance))
+        print("- convergence step : {}".format(step))
+        print("- binning : {}".format(binning))
+        print("- header index : {}".format(index_folder))
         print("\na message will be displayed each time a value is modified\n")
 
     # list of all the parameters accepted by the code
-    input_list = ['image folder', 'number of samples', 'model name']
+    input_list = ['image folder', 'number of samples', 'model name', 'memory budget', 'number of workers', 'seed', 'model store', 'dtype',
+                  'band', 'beg date', 'end date', 'read ahead', 'sky estimator', 'streaming bins', 'checkpoint', 'shard folder',
+                  'convergence tolerance', 'convergence step', 'binning', 'header index']
 
     # dictionnary with a function associated to each parameter if necessary to read them correctly
     input_dic = {'image folder' : do_nothing,
                  'number of samples': read_int,
                  'model name' : do_nothing,
+                 'memory budget' : read_int,
+                 'number of workers' : read_int,
+                 'seed' : read_int,
+                 'model store' : do_nothing,
+                 'dtype' : ut.read_dtype,
+                 'band' : do_nothing,
+                 'beg date' : read_date,
+                 'end date' : read_date,
+                 'read ahead' : read_int,
+                 'sky estimator' : ut.read_sky,
+                 'streaming bins' : read_int,
+                 'checkpoint' : do_nothing,
+                 'shard folder' : do_nothing,
+                 'convergence tolerance' : read_float,
+                 'convergence step' : read_int,
+                 'binning' : read_int,
+                 'header index' : do_nothing,
                  }
 
     # checking if there is a file
@@ -125,7 +314,10 @@ def read_setup(file, verbose):
         exit()
     text.close()
 
-    return tuple(param_list) 
+    # the conditions on the images, read in the catalogue of the headers of the folder
+    selection = {'band' : param_list[8], 'date1' : param_list[9], 'date2' : param_list[10]}
+
+    return tuple(param_list[:8]) + (selection,) + tuple(param_list[11:])
 
 
 if __name__ == "__main__":
@@ -134,30 +326,93 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help="setup file needed to execute the code")
     parser.add_argument('-v', '--verbose', help="gives more information", action="store_true")
+    parser.add_argument('--shard', help="makes only the samples of this shard, given as index/number (e. g. 2/8), "
+                                        "and writes their fringe maps in the shard folder", type=read_shard)
+    parser.add_argument('--reduce', help="makes the model with the fringe maps written by all the shards in the shard folder",
+                        action="store_true")
+    pr.add_arguments(parser)
     args = parser.parse_args()
     f_name = args.file
     verbose = args.verbose
+    pr.start(args.profile, args.cprofile, args.tracemalloc)
 
 
 
     # reading the setup file
-    folder_name, N_samples, model_name = read_setup(f_name, verbose)
-
-    # creating a temporary file in which the _pierside images will be gathered for the model
-
-    path = "tmp_pierside"
-    if not os.path.exists(path):
-        os.mkdir(path)
-
-    images = glob.glob(folder_name + '\\*.fits')
-    for image in images:
-        ut.pierside(image, path)
-
-    # first, we gather the fringe maps
-    fringe_maps, N_samples = ut.gather_normalized_images(path, N_samples)
-
-    # then we delete the temporary file
-    shutil.rmtree(path)
-
-    # finally, we create the model
-    create_model(fringe_maps, model_name, folder_name, N_samples)
+    (folder_name, N_samples, model_name, memory, workers, seed, store, dtype, selection, read_ahead, sky, bins, checkpoint,
+     shard_folder, tolerance, step, binning, index_folder) = read_setup(f_name, verbose)
+    shard = args.shard
+    hi.set_index_folder(index_folder)
+
+    # with shards, the samples are shared between several runs (map), and the model is made by another run (reduce)
+    if ((shard is not None) or args.reduce) and (shard_folder is None):
+        print("NO SHARD FOLDER GIVEN")
+        print("the shards write their fringe maps in the shard folder, please give it in the setup file")
+        exit()
+    if (shard is not None) and (seed is None):
+        print("NO SEED GIVEN")
+        print("all the shards must make the same samples, please give a seed in the setup file")
+        exit()
+    use_store = (store is not None) and (shard is None) and not args.reduce
+
+    # first, we gather the fringe maps, the images with a 'WEST' pierside are rotated while being read
+    # with a memory budget, the fringe maps are kept on the disk in a temporary file
+    # with a model store, only the fringe maps of the samples with new or removed images are made
+    # with streaming bins (and no store), the fringe maps are not kept, only their histograms
+    # with a checkpoint (and no store), each fringe map is kept as soon as it is done, and a run interrupted starts again from there
+    # with a convergence tolerance (and no store or shard), no more samples are made once the model does not change anymore
+    # with a shard, only the samples of the shard are made, and their fringe maps are written in the shard folder
+    maps_name = "tmp_fringe_maps.npy"
+    if shard is not None:
+        # each shard has its own temporary files, so that several shards can run in the same folder
+        maps_name = "tmp_fringe_maps_{}_of_{}.npy".format(*shard)
+        if checkpoint is not None:
+            checkpoint = "{}_{}_of_{}".format(checkpoint, *shard)
+        images = hi.select_images(folder_name, **selection)
+        N_images = len(images)
+        bands, date1, date2 = hi.images_summary(folder_name, images)
+        if N_samples is None:
+            N_samples = N_images
+
+    if args.reduce:
+        fringe_maps, N_samples, parameters = read_shards(shard_folder)
+        # the model is made with the parameters of the shards, not with the ones of the setup file of the reduction
+        dtype = np.dtype(parameters['dtype'])
+        selection = parameters['selection']
+        binning = parameters.get('binning', 1)
+        # the folder, the bands and the dates of the images are the ones seen by the shards
+        # (the folder may not be reachable from the reduction)
+        folder_name = parameters.get('folder', folder_name)
+        summary = (parameters['bands'], parameters['date1'], parameters['date2']) if 'bands' in parameters else None
+    elif use_store:
+        fringe_maps, N_samples = ut.update_model_store(folder_name, store, N_samples, memory, workers, dtype, selection, read_ahead, sky,
+                                                       binning)
+    else:
+        fringe_maps, N_maps = ut.gather_normalized_images(folder_name, N_samples, memory, maps_name, workers, seed, dtype, selection,
+                                                          read_ahead, sky, bins if shard is None else None, checkpoint, shard,
+                                                          tolerance if shard is None else None, step, binning)
+        if shard is None:
+            N_samples = N_maps
+
+    # finally, we create the model, or the shard writes its fringe maps for the reduction
+    if shard is not None:
+        parameters = {'N_samples' : N_samples, 'N_images' : N_images, 'seed' : seed, 'selection' : selection,
+                      'sky' : sky, 'dtype' : np.dtype(dtype).name, 'binning' : binning,
+                      'folder' : folder_name, 'bands' : bands, 'date1' : date1, 'date2' : date2}
+        write_shard(fringe_maps, shard_folder, shard, parameters)
+        print("the fringe maps of the shard {}/{} are written in {}".format(shard[0], shard[1], shard_folder))
+    else:
+        create_model(fringe_maps, model_name, folder_name, N_samples, memory, dtype, selection, bins, binning,
+                     summary if args.reduce else None)
+
+    # and we delete the fringe maps kept on the disk (but not the ones of the store or of the shards)
+    if not (args.reduce or use_store):
+        if checkpoint is not None:
+            del fringe_maps
+            os.remove(os.path.join(checkpoint, 'fringe_maps.npy'))
+            os.remove(os.path.join(checkpoint, 'checkpoint.json'))
+            os.remove(os.path.join(checkpoint, 'done.jsonl'))
+            os.rmdir(checkpoint)
+        elif (memory is not None) and not isinstance(fringe_maps, ut.StreamingMedian):
+            del fringe_maps
+            os.remove(maps_name)
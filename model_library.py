@@ -0,0 +1,141 @@
+# !/usr/bin/env python
+
+import os
+import glob
+import json
+import datetime
+from astropy.io import fits
+import header_index as hi
+
+"""Keeps an index of a library of models (a folder of models made with model.py),
+to choose for each image the model made with the images closest to it:
+same shape, same band, and observation dates around the date of the image.
+
+The index (library/library.json) records the shape, the band and the dates of the images of each model,
+read in the header of the model (keys FILTER, DATE-BEG and DATE-END written by create_model).
+It is updated incrementally: only the new or modified models (size, modification time) are read."""
+
+def model_info(model_name):
+    """reads in the header of a model the shape of its images, its band and the first and last dates (YYYY-MM-DD)
+    of the images used to make it. The band and the dates are None for the models made before
+    these keys were written, such models match any band and any date.
+    The shape of a preview model (made with binned images) is the shape of the images before the binning"""
+    header = fits.getheader(model_name)
+    date1 = header.get('DATE-BEG')
+    date2 = header.get('DATE-END')
+    binning = header.get('BINNING', 1)
+    return {'shape' : [header['NAXIS1'] * binning, header['NAXIS2'] * binning],
+            'binning' : binning,
+            'band' : header.get('FILTER'),
+            'date1' : None if date1 is None else date1[:10],
+            'date2' : None if date2 is None else date2[:10]}
+
+def update_library(library):
+    """updates the index of the models of the folder library and returns it:
+    a dictionary model name : information of the model (see model_info) and signature of the file"""
+
+    index_name = os.path.join(library, 'library.json')
+    index = {}
+    if os.path.exists(index_name):
+        with open(index_name, 'r') as f:
+            index = json.load(f)
+
+    models = {}
+    changed = False
+    for model_name in glob.glob(os.path.join(library, '*.fits')):
+        signature = hi.file_signature(model_name)
+        entry = index.get(model_name)
+        if (entry is None) or (entry['signature'] != signature):
+            entry = model_info(model_name)
+            entry['signature'] = signature
+            changed = True
+        models[model_name] = entry
+    changed = changed or (len(models) != len(index))
+
+    if changed: # written safely (temporary file then renaming)
+        with open(index_name + '.tmp', 'w') as f:
+            json.dump(models, f, indent=1)
+        os.replace(index_name + '.tmp', index_name)
+
+    return models
+
+def days_between(date, date1, date2):
+    """returns the number of days between date and the interval [date1, date2] (0 if date is in it).
+    The dates are strings YYYY-MM-DD, if one of them is missing the distance is 0"""
+    if (date is None) or (date1 is None) or (date2 is None):
+        return 0
+    day = datetime.date.fromisoformat(date[:10])
+    if day < datetime.date.fromisoformat(date1):
+        return (datetime.date.fromisoformat(date1) - day).days
+    if day > datetime.date.fromisoformat(date2):
+        return (day - datetime.date.fromisoformat(date2)).days
+    return 0
+
+def best_model(models, shape, band=None, date=None):
+    """chooses among the models of the index (see update_library) the best model for an image
+    with the shape [NAXIS1, NAXIS2], the band and the observation date (DATE-OBS) given.
+
+    The model must have the same shape. The models of the same band come first, then the models
+    whose band is unknown. Among them, the model whose dates are the closest to the date of the image is chosen,
+    a full resolution model rather than a preview model,
+    and if several models contain the date, the one made over the shortest period.
+
+    returns the name of the model, or None if no model has the shape of the image"""
+
+    best = None
+    best_score = None
+    for model_name, info in models.items():
+        if list(info['shape']) != list(shape):
+            continue
+        if (band is not None) and (info['band'] is not None) and (info['band'] != band):
+            continue
+
+        unknown_band = (band is None) or (info['band'] is None)
+        distance = days_between(date, info['date1'], info['date2'])
+        if (info['date1'] is not None) and (info['date2'] is not None):
+            period = (datetime.date.fromisoformat(info['date2']) - datetime.date.fromisoformat(info['date1'])).days
+        else:
+            period = float('inf') # a model without dates comes after the models with dates
+        score = (unknown_band, distance, info.get('binning', 1), period, model_name)
+
+        if (best_score is None) or (score < best_score):
+            best, best_score = model_name, score
+
+    return best
+
+def match_models(images, library, folder=None):
+    """chooses the best model of the library for each image of the list images.
+    The shape, the band and the date of the images are taken from the catalogue of the headers of folder
+    (see header_index.py) if it is given, else from their headers.
+
+    returns a dictionary model name : list of the images reduced with this model,
+    and the list of the images for which no model was found"""
+
+    models = update_library(library)
+    if folder is not None:
+        hi.update_index(folder)
+
+    groups = {}
+    unmatched = []
+    for image_name in images:
+        if folder is not None:
+            info = hi.header_info(folder, image_name)
+            shape = [info['naxis1'], info['naxis2']]
+            band = info['band']
+            date = info['date_obs']
+        else:
+            header = fits.getheader(image_name)
+            shape = [header['NAXIS1'], header['NAXIS2']]
+            band = hi.band_of(image_name)
+            date = header.get('DATE-OBS')
+
+        model_name = best_model(models, shape, band, date)
+        if model_name is None:
+            unmatched.append(image_name)
+        else:
+            groups.setdefault(model_name, []).append(image_name)
+
+    return groups, unmatched
+
+if __name__ == "__main__":
+    pass
\ No newline at end of file
@@ -0,0 +1,171 @@
+# !/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import atexit
+import datetime
+import threading
+import cProfile
+import tracemalloc
+
+try:
+    import resource # not available on Windows, the peak memory is then not measured
+except ImportError:
+    resource = None
+
+"""measures the time, the bytes read and written and the peak memory of each stage of the codes.
+
+The codes mark their stages with
+    with pr.Stage('fits read') as stage:
+        ...
+        stage.bytes_read += data.nbytes
+which costs nothing when the profiling is not started (option --profile of the codes).
+At the end of the run, a .json report gives for each stage its number of calls, its total time,
+the bytes read and written and the peak memory (RSS) of the process at the end of the stage.
+The times of the stages run at the same time in several threads or processes are added."""
+
+enabled = False # True when the stages are measured
+records = {} # name of the stage : measures
+lock = threading.Lock() # the download threads record their stages at the same time
+run = {} # the options and the beginning of the run
+
+def peak_rss(who=None):
+    """returns the peak memory (RSS) in MB of the process (or of its finished child processes
+    if who is 'children'), None if it can't be measured"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF)
+    if sys.platform == 'darwin': # in bytes on macOS, in kB elsewhere
+        return usage.ru_maxrss / 1024**2
+    return usage.ru_maxrss / 1024
+
+def add(name, calls=1, duration=0., bytes_read=0, bytes_written=0, rss=None):
+    """adds the measures of one or several calls of a stage to the records"""
+    with lock:
+        record = records.setdefault(name, {'calls' : 0, 'time' : 0., 'bytes read' : 0, 'bytes written' : 0, 'peak rss' : None})
+        record['calls'] += calls
+        record['time'] += duration
+        record['bytes read'] += bytes_read
+        record['bytes written'] += bytes_written
+        if (rss is not None) and ((record['peak rss'] is None) or (rss > record['peak rss'])):
+            record['peak rss'] = rss
+
+class Stage:
+    """context manager measuring one call of a stage of the codes (see the beginning of the file).
+    bytes_read and bytes_written are set by the code of the stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        if enabled:
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *error):
+        if enabled:
+            add(self.name, 1, time.perf_counter() - self.t0, self.bytes_read, self.bytes_written, peak_rss())
+        return False
+
+def file_size(file_name):
+    """returns the size of a file, 0 if it does not exist"""
+    return os.path.getsize(file_name) if os.path.exists(file_name) else 0
+
+# the worker processes measure their stages themselves and send them back with their results
+
+def init_worker(state):
+    """starts (state = True) or stops the measures of the stages in a worker process.
+    The records of the worker begin empty, a forked process has a copy of the records of the main process"""
+    global enabled
+    enabled = state
+    records.clear()
+
+def take():
+    """returns the records of the stages and empties them, to send them to the main process"""
+    with lock:
+        taken = dict(records)
+        records.clear()
+    return taken
+
+def merge(taken):
+    """adds the records of another process (see take) to the records"""
+    for name, record in taken.items():
+        add(name, record['calls'], record['time'], record['bytes read'], record['bytes written'], record['peak rss'])
+
+# beginning and end of a run
+
+def start(report_name=None, cprofile_name=None, trace=False):
+    """starts the measures of the run of a code.
+
+    report_name : the .json file in which the report of the stages is written at the end of the run.
+    cprofile_name : if given, the whole run is profiled with cProfile and the statistics are written in this file
+    (they can be read with the module pstats).
+    trace : if True, the memory allocations are traced with tracemalloc and the lines allocating
+    the most memory are added to the report (and printed). Tracing slows the code down."""
+
+    global enabled
+    if (report_name is None) and (cprofile_name is None) and not trace:
+        return
+
+    enabled = True
+    run['report'] = report_name
+    run['cprofile'] = cprofile_name
+    run['trace'] = trace
+    run['date'] = datetime.datetime.today().isoformat(timespec='seconds')
+    run['t0'] = time.perf_counter()
+
+    if trace:
+        tracemalloc.start()
+    if cprofile_name is not None:
+        run['profiler'] = cProfile.Profile()
+        run['profiler'].enable()
+
+    # the report is written even if the code stops with exit()
+    atexit.register(finish)
+
+def finish():
+    """ends the measures of the run and writes the report"""
+
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+
+    report = {'command' : ' '.join(sys.argv),
+              'date' : run['date'],
+              'wall time' : time.perf_counter() - run['t0'],
+              'peak rss' : peak_rss(),
+              'peak rss of the workers' : peak_rss('children'),
+              'stages' : records}
+
+    if 'profiler' in run:
+        run['profiler'].disable()
+        run['profiler'].dump_stats(run['cprofile'])
+        print("cProfile statistics written in {}".format(run['cprofile']))
+
+    if run['trace']:
+        snapshot = tracemalloc.take_snapshot()
+        report['traced peak'] = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        report['biggest allocations'] = [str(statistic) for statistic in snapshot.statistics('lineno')[:10]]
+        print("\npeak memory traced : {:.1f} MB, biggest allocations still in memory :".format(report['traced peak']))
+        for line in report['biggest allocations']:
+            print(line)
+
+    if run['report'] is not None:
+        with open(run['report'], 'w') as f:
+            json.dump(report, f, indent=1)
+        print("profile of the run written in {}".format(run['report']))
+
+def add_arguments(parser):
+    """adds the options of the profiling to the parser of the arguments of a code"""
+    parser.add_argument('--profile', help="writes the time, the bytes read and written and the peak memory of each stage in this .json file")
+    parser.add_argument('--cprofile', help="profiles the run with cProfile and writes the statistics in this file")
+    parser.add_argument('--tracemalloc', help="traces the memory allocations (slower)", action="store_true")
+
+if __name__ == "__main__":
+    pass
\ No newline at end of file
@@ -1,105 +1,599 @@
 # !/usr/bin/env python
 
 import utils as ut
+import profiling as pr
 from astropy.io import fits
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import argparse
 import glob
+import os
+import json
+import hashlib
 import version as v
+import header_index as hi
+import model_library as ml
+import signal
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, shared_memory
+
+try:
+    # optional, to be told at once when an image lands in the watched folder
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
     
 """Code which removes the fringing from the images of IRiS."""
 
 def flip_image(image):
-    shape = image.shape
-    image = image.flatten()
-    image = image[::-1] # rotation
-    image = np.reshape(image, shape)
-    return image
+    """rotates an image of 180°, returns a view of the image (no copy)"""
+    return image[::-1, ::-1]
+
+def integral_image(data):
+    """returns the summed-area table of an image, with a first row and column of zeros:
+    sat[i, j] is the sum of data[:i, :j]. The sums are done in float64."""
+    sat = np.zeros((data.shape[0] + 1, data.shape[1] + 1))
+    sat[1:, 1:] = np.cumsum(np.cumsum(data, axis=0, dtype=np.float64), axis=1)
+    return sat
+
+def box_means(sat, x, y, delta_pixel):
+    """calculates at once the means of the pixel values in the square boxes centered on (x, y)
+    (x : rows, y : columns), using the summed-area table sat of the image.
+    delta_pixel is the half width of the boxes, it can be an int or a list of half widths.
+
+    returns an array of shape (number of half widths, number of boxes)"""
+
+    n_rows = sat.shape[0] - 1
+    n_cols = sat.shape[1] - 1
+    x = np.asarray(x)
+    y = np.asarray(y)
+    delta_pixel = np.atleast_1d(delta_pixel)[:, np.newaxis] # one line per half width
+
+    # limits of the boxes, cut at the edges of the image like a slice would do
+    x_min = np.clip(x - delta_pixel, 0, n_rows)
+    x_max = np.clip(x + 1 + delta_pixel, 0, n_rows)
+    y_min = np.clip(y - delta_pixel, 0, n_cols)
+    y_max = np.clip(y + 1 + delta_pixel, 0, n_cols)
+
+    sums = sat[x_max, y_max] - sat[x_min, y_max] - sat[x_max, y_min] + sat[x_min, y_min]
+    return sums / ((x_max - x_min) * (y_max - y_min))
+
+def window_means(image, x, y, delta_pixel):
+    """calculates at once the means of the pixel values in the square boxes of half width delta_pixel
+    centered on (x, y) (x : rows, y : columns), reading only the pixels of the boxes.
+    The boxes cut by the edges of the image are cut like a slice would do, as in box_means.
+
+    returns an array with the mean of each box"""
+
+    n_rows, n_cols = image.shape
+    x = np.asarray(x)
+    y = np.asarray(y)
+    means = np.zeros(len(x))
+
+    # the boxes inside the image are gathered in one step, as views of the image
+    inside = (x - delta_pixel >= 0) & (x + delta_pixel < n_rows) & (y - delta_pixel >= 0) & (y + delta_pixel < n_cols)
+    if np.any(inside):
+        windows = sliding_window_view(image, (2 * delta_pixel + 1, 2 * delta_pixel + 1))
+        means[inside] = windows[x[inside] - delta_pixel, y[inside] - delta_pixel].mean(axis=(-2, -1), dtype=np.float64)
+
+    for i in np.flatnonzero(~inside):
+        box = image[max(x[i] - delta_pixel, 0):x[i] + 1 + delta_pixel, max(y[i] - delta_pixel, 0):y[i] + 1 + delta_pixel]
+        means[i] = np.mean(box, dtype=np.float64)
+
+    return means
+
+def delta_flux(pairs, image, delta_pixel):
+    """calculates the variation of light flux between the two ends of each control pair
+    of an image, for one or several half widths delta_pixel.
+    With one half width, only the pixels of the boxes are read (see window_means).
+    With several half widths, the summed-area table of the image is built once for all of them (see box_means)."""
+
+    # getting all the coordinates of the ends of the pairs
+    y1, x1, y2, x2 = pairs
+
+    if np.ndim(delta_pixel) == 0: # only one box width
+        return window_means(image, x1, y1, delta_pixel) - window_means(image, x2, y2, delta_pixel)
+
+    sat = integral_image(image)
+    return box_means(sat, x1, y1, delta_pixel) - box_means(sat, x2, y2, delta_pixel)
 
 def delta_flux_ref(pairs, model_name, delta_pixel):
     """calculates the variation of light flux between the two
     ends of each control pairs from "pairs", and put the results in an array delta_flux.
     The value at the end of a pair is done by calculating the mean of the pixel values
-    in a square box. The half width of the box is given by bow_width
+    in a square box. The half width of the box is given by delta_pixel.
+    If delta_pixel is a list of half widths, delta_flux has one line per half width.
+
+    A preview model (made with binned images, key BINNING of its header) is expanded to the full resolution first,
+    so that the boxes are the same on the model and on the images.
+    The pairs whose delta_flux is 0 on the model (e. g. both ends in the same pixel of a preview model)
+    are not used by ratio_med.
     
     returns the delta_flux_model and the model matrix normalized"""
 
     # getting the model
     with fits.open(model_name) as f:
         model = f[0].data
+        model_binning = f[0].header.get('BINNING', 1)
 
-    # getting all the coordinates of the ends of the pairs
-    y1, x1, y2, x2 = pairs
-
-    # creating the array delta_flux
-    n_pairs = len(x1)
-    delta_flux = np.zeros(n_pairs)
+    model = ut.expand_image(model, model_binning)
+    delta_flux_model = delta_flux(pairs, model, delta_pixel)
 
-    # calculating all the delta flux
-    for i in range(n_pairs):
-        model_plus = np.mean(model[x1[i] - delta_pixel: x1[i] + 1 + delta_pixel, y1[i] - delta_pixel: y1[i] + 1 + delta_pixel])
-        model_minus = np.mean(model[x2[i] - delta_pixel: x2[i] + 1 + delta_pixel, y2[i] - delta_pixel: y2[i] + 1 + delta_pixel])
-        d_flux = (model_plus - model_minus)
-        delta_flux[i] = d_flux
+    # the pairs which can't give a ratio
+    unused = np.any(np.atleast_2d(delta_flux_model) == 0, axis=0)
+    if np.all(unused):
+        raise ValueError("no control pair gives a ratio, the model is the same at both ends of all the pairs")
+    if np.any(unused):
+        print("{} control pairs of {} are not used: the model is the same at both ends".format(np.sum(unused), len(unused)))
 
-    return delta_flux, model
+    return delta_flux_model, model
 
 def ratio_med(pairs, delta_flux_model, image, delta_pixel):
     """calculates the median ratio between the delta_flux of the model
     and the delta_flux of the image
     The value at the end of a pair (given in the pairs tuple) is done by calculating the mean of the pixel values
-    in a square box. The half width of the box is given by bow_width
+    in a square box. The half width of the box is given by delta_pixel.
+    If delta_pixel is a list of half widths, one median ratio is given for each of them.
+    Only the pixels of the boxes are read (see delta_flux), at full resolution.
+    The pairs with a delta_flux_model of 0 are not used.
     
     returns the median ratio and the image matrix normalized"""
 
-    # collecting the pairs    
-    y1, x1, y2, x2 = pairs
-
-    # creating the delta_flux array for the image
-    n_pairs = delta_flux_model.size
-    delta_flux_image = np.zeros(n_pairs)
-
     # calcultates the delta_flux on the image
-    for i in range(n_pairs):
-        image_plus = np.mean(image[x1[i] - delta_pixel: x1[i] + 1 + delta_pixel, y1[i] - delta_pixel: y1[i] + 1 + delta_pixel])
-        image_minus = np.mean(image[x2[i] - delta_pixel: x2[i] + 1 + delta_pixel, y2[i] - delta_pixel: y2[i] + 1 + delta_pixel])
-        d_flux = (image_plus - image_minus)
-        delta_flux_image[i] = d_flux
+    delta_flux_image = delta_flux(pairs, image, delta_pixel)
 
-    # calculates the ratios and takes the median
-    ratio = (delta_flux_image/delta_flux_model)
-    median = np.median(ratio)
+    # calculates the ratios and takes the median, without the pairs which can't give a ratio
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(delta_flux_model != 0, delta_flux_image/delta_flux_model, np.nan)
+    median = np.nanmedian(ratio, axis=-1)
 
     return median
 
-def remove(pairs, model, delta_flux_model, image_name, delta_pixel, model_name, control):
+def read_image(image_name):
+    """reads an image with an 'EAST' pierside (rotated if the pierside is 'WEST') for remove.
+    returns the data (in memory), the header and a boolean which is True if the image was rotated"""
+    with pr.Stage('fits read') as stage:
+        image, header, flipped = ut.load_image(image_name)
+        image = np.array(image) # the image is read here, it is used twice after
+        stage.bytes_read = image.nbytes
+    return image, header, flipped
+
+def correct_image(pairs, model, delta_flux_model, image, header, flipped, delta_pixel, model_name, control, dtype=np.float32):
+    """removes the fringing on an image read with read_image, see remove.
+    returns the corrected image, in its initial orientation, and its header"""
+
+    # writing the changes in the header's history
+    header['HISTORY'] = "fringing removed with remove_fringing.py (version {})".format(v.version_remove())
+    header['HISTORY'] = "using the model {}".format(model_name)
+    header['HISTORY'] = "using the control pairs {}".format(control)
+    header['HISTORY'] = "mean done with a box width of {} pixels".format(2 * delta_pixel + 1)
+
+    # the ratio is computed with the image and the model in the same orientation
+    with pr.Stage('ratio estimation'):
+        ratio = ratio_med(pairs, delta_flux_model, image, delta_pixel)
+
+    # subtraction of the model to the initial image
+    # the model is rotated instead of the image, so that the result is directly in the initial orientation
+    with pr.Stage('pierside handling'):
+        if flipped:
+            image = flip_image(image)
+            model = flip_image(model)
+    with pr.Stage('subtraction'):
+        image = np.subtract(image, np.multiply(model, ratio, dtype=dtype), dtype=dtype)
+
+    return image, header
+
+def write_image(file_name, image, header):
+    """writes a corrected image safely: in a temporary file first, then renamed (see utils.update_fits),
+    so that an interrupted writing never leaves a broken image"""
+    with pr.Stage('write') as stage:
+        ut.update_fits(file_name, image, header)
+        stage.bytes_written = pr.file_size(file_name)
+
+def remove(pairs, model, delta_flux_model, image_name, delta_pixel, model_name, control, dtype=np.float32):
     """removes the fringing on the image with the name
     image_name, given some control pairs (given by "pairs") and the array
     of delta_flux of the model corresponding to these pairs
     The value at the end of a pair is done by calculating the mean of the pixel values
-    in a square box. The half width of the box is given by bow_width"""
-
-    # writing the changes in the header's history
-    with fits.open(image_name) as f:
-        image = f[0].data
-        header = f[0].header
-        header['HISTORY'] = "fringing removed with remove_fringing.py (version {})".format(v.version_remove())
-        header['HISTORY'] = "using the model {}".format(model_name)
-        header['HISTORY'] = "using the control pairs {}".format(control)
-        header['HISTORY'] = "mean done with a box width of {} pixels".format(2 * delta_pixel + 1)
-    pierside = header['PIERSIDE'].strip()
-    if pierside == 'WEST':
-        image = flip_image(image)
+    in a square box. The half width of the box is given by bow_width
+    The corrected image is saved with the type dtype, the ratio is computed in float64"""
+
+    image, header, flipped = read_image(image_name)
+    image, header = correct_image(pairs, model, delta_flux_model, image, header, flipped, delta_pixel, model_name, control, dtype)
+    write_image(corrected_name(image_name), image, header)
+
+def remove_pipeline(images, pairs, model, delta_flux_model, delta_pixel, model_name, control, report, dtype=np.float32,
+                    read_ahead=2, writers=2):
+    """removes the fringing on all the images of the list images in the main process, with the reading
+    and the writing of the images overlapped with the computations: the next read_ahead images are read
+    by a background thread while an image is corrected, and the corrected images are written by writers threads.
+    At most read_ahead images wait to be corrected and read_ahead images wait to be written.
+    report(image_name, error) is called for each image, error is None if the image was reduced"""
+
+    writing = deque()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        for image_name, loaded, error in ut.prefetch(read_image, images, read_ahead):
+            if error is None:
+                try:
+                    image, header = correct_image(pairs, model, delta_flux_model, *loaded, delta_pixel, model_name, control, dtype)
+                    writing.append((image_name, executor.submit(write_image, corrected_name(image_name), image, header)))
+                    del image, loaded
+                except Exception as exception: # an image which can't be reduced must not stop the others
+                    error = exception
+            if error is not None:
+                report(image_name, "{}: {}".format(type(error).__name__, error))
+
+            # waits for the oldest writing when enough images wait to be written
+            while len(writing) > read_ahead or ((len(writing) > 0) and writing[0][1].done()):
+                image_name, future = writing.popleft()
+                error = future.exception()
+                report(image_name, None if error is None else "{}: {}".format(type(error).__name__, error))
+
+        while writing:
+            image_name, future = writing.popleft()
+            error = future.exception()
+            report(image_name, None if error is None else "{}: {}".format(type(error).__name__, error))
+
+# functions to reduce a whole folder with several processes
+
+worker_state = {} # what each worker process needs to reduce the images, set once by init_worker
+
+def init_worker(shm_name, model_shape, model_dtype, pairs, delta_flux_model, delta_pixel, model_name, control, dtype, profiling=False):
+    """initializes a worker process of remove_folder: the model is not copied,
+    the worker uses the model in the shared memory block shm_name.
+    profiling : if True, the worker measures its stages (see profiling.py)"""
+    pr.init_worker(profiling)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    model = np.ndarray(model_shape, dtype=model_dtype, buffer=shm.buf)
+    worker_state['shm'] = shm # the shared memory must stay open as long as the worker lives
+    worker_state['args'] = (pairs, model, delta_flux_model, delta_pixel, model_name, control, dtype)
+
+def remove_worker(image_name):
+    """reduces one image in a worker process.
+    returns the image name, the error message, which is None if the image was reduced,
+    and the measures of the stages (see profiling.take)"""
+    pairs, model, delta_flux_model, delta_pixel, model_name, control, dtype = worker_state['args']
+    try:
+        remove(pairs, model, delta_flux_model, image_name, delta_pixel, model_name, control, dtype)
+    except Exception as error: # an image which can't be reduced must not stop the others
+        return image_name, "{}: {}".format(type(error).__name__, error), pr.take()
+    return image_name, None, pr.take()
+
+def remove_folder(images, pairs, model, delta_flux_model, delta_pixel, model_name, control, workers=1, verbose=False, dtype=np.float32,
+                  read_ahead=2, writers=2):
+    """removes the fringing on all the images of the list images, with a pool of workers processes.
+    The model is loaded once in a shared memory block used by all the workers.
+    With one worker, the images are read in advance and written in background threads (see remove_pipeline),
+    unless read_ahead is 0.
+    If an image can't be reduced, the error is reported and the other images are still reduced.
+
+    returns the list of the images which could not be reduced, with their error messages"""
+
+    failed = []
+
+    def report(image_name, error):
+        if error is None:
+            if verbose:
+                print("{} reduced".format(image_name))
+        else:
+            print("{} could not be reduced : {}".format(image_name, error))
+            failed.append((image_name, error))
+
+    if (workers <= 1) and (read_ahead > 0):
+        remove_pipeline(images, pairs, model, delta_flux_model, delta_pixel, model_name, control, report, dtype, read_ahead, writers)
+        return failed
+    if workers <= 1:
+        for im in images:
+            try:
+                remove(pairs, model, delta_flux_model, im, delta_pixel, model_name, control, dtype)
+                report(im, None)
+            except Exception as error:
+                report(im, "{}: {}".format(type(error).__name__, error))
+        return failed
+
+    # the model is copied once in a shared memory block
+    shm = shared_memory.SharedMemory(create=True, size=model.nbytes)
+    shared_model = np.ndarray(model.shape, dtype=model.dtype, buffer=shm.buf)
+    shared_model[:] = model
+
+    initargs = (shm.name, model.shape, model.dtype, pairs, delta_flux_model, delta_pixel, model_name, control, dtype, pr.enabled)
+    try:
+        with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            for image_name, error, records in pool.imap_unordered(remove_worker, images):
+                pr.merge(records)
+                report(image_name, error)
+    finally:
+        del shared_model # the buffer must be released before closing the shared memory
+        shm.close()
+        shm.unlink()
+
+    return failed
+
+# functions to reduce the images as they land in a folder, with the model kept in memory
+
+def corrected_name(image_name):
+    """gives the name of the corrected image of an image"""
+    return image_name.split(".fits")[0] + "_fringecor.fits"
+
+def images_to_reduce(folder):
+    """returns the images of folder which are not reduced yet"""
+    images = glob.glob(os.path.join(folder, '*.fits'))
+    return [im for im in images if ("_fringecor" not in im) and not os.path.exists(corrected_name(im))]
+
+def fits_complete(image_name, size):
+    """checks that a .fits file of size bytes has all the bytes announced by its header:
+    an image still being copied in the folder is not complete"""
+    try:
+        header = fits.getheader(image_name)
+    except Exception: # the header itself is not complete, or the file is not a .fits file
+        return False
+    n_pixels = 1
+    for axis in range(header['NAXIS']):
+        n_pixels *= header['NAXIS{}'.format(axis + 1)]
+    data_bytes = n_pixels * abs(header['BITPIX']) // 8 if header['NAXIS'] > 0 else 0
+    return size >= len(header.tostring()) + data_bytes # the header is padded to blocks of 2880 bytes
+
+def start_observer(folder, wake):
+    """if watchdog is installed, starts an observer of folder (inotify on Linux) which sets the event wake
+    each time a file is created or modified in the folder. returns the observer, or None without watchdog"""
+    if Observer is None:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            wake.set()
+
+    observer = Observer()
+    observer.schedule(Handler(), folder, recursive=False)
+    observer.start()
+    return observer
+
+def init_watch_worker(*args):
+    """initializes a worker process of watch_folder: like init_worker, but the worker ignores Ctrl+C,
+    the main process stops the workers itself once their images are reduced"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(*args)
+
+def watch_folder(folder, pairs, model, delta_flux_model, delta_pixel, model_name, control, workers=1, verbose=False,
+                 dtype=np.float32, interval=2., queue_size=16):
+    """reduces the images of folder as they land in it, until Ctrl+C (or SIGTERM) is received.
+    The model, the pairs and delta_flux_model are loaded once and stay in memory.
+
+    The folder is scanned every interval seconds (or as soon as a file changes if watchdog is installed).
+    An image is reduced when its size did not change between two scans and it has all the bytes announced
+    by its header, so that an image still being copied is not read. The files which never become complete
+    .fits files are left in the folder. The images already reduced (with a _fringecor file) are skipped.
+    At most queue_size images are waiting or being reduced at the same time, the next ones wait in the folder.
+    When the daemon is stopped, the images already given to the workers are finished first.
+
+    returns the list of the images which could not be reduced, with their error messages"""
+
+    stop = threading.Event()
+    wake = threading.Event()
+
+    def shutdown(signum, frame):
+        print("\nstopping: the images being reduced are finished first")
+        stop.set()
+        wake.set()
+
+    handlers = {sig : signal.signal(sig, shutdown) for sig in (signal.SIGINT, signal.SIGTERM)}
+    observer = start_observer(folder, wake)
+
+    failed = []
+    done = set() # the images reduced or failed during this run
+    sizes = {} # the size of each image at the previous scan
+    in_flight = {} # the images given to the workers, with their results
+
+    def report(image_name, error):
+        done.add(image_name)
+        if error is None:
+            if verbose:
+                print("{} reduced".format(image_name))
+        else:
+            print("{} could not be reduced : {}".format(image_name, error))
+            failed.append((image_name, error))
+
+    pool = None
+    shm = None
+    if workers > 1:
+        # the model is copied once in a shared memory block, as in remove_folder
+        shm = shared_memory.SharedMemory(create=True, size=model.nbytes)
+        shared_model = np.ndarray(model.shape, dtype=model.dtype, buffer=shm.buf)
+        shared_model[:] = model
+        initargs = (shm.name, model.shape, model.dtype, pairs, delta_flux_model, delta_pixel, model_name, control, dtype, pr.enabled)
+        pool = Pool(workers, initializer=init_watch_worker, initargs=initargs)
+
+    print("watching {} (Ctrl+C to stop)".format(folder))
+    try:
+        while not stop.is_set():
+            # the results of the workers
+            for image_name in [im for im in in_flight if in_flight[im].ready()]:
+                name, error, records = in_flight.pop(image_name).get()
+                pr.merge(records)
+                report(name, error)
+
+            # the images which did not change since the previous scan are reduced
+            for image_name in images_to_reduce(folder):
+                if stop.is_set() or (len(in_flight) >= queue_size):
+                    break
+                if (image_name in done) or (image_name in in_flight):
+                    continue
+                try:
+                    size = os.path.getsize(image_name)
+                except OSError: # the image was moved away
+                    continue
+                if (sizes.get(image_name) != size) or not fits_complete(image_name, size):
+                    sizes[image_name] = size # seen for the first time or still being copied
+                    continue
+                del sizes[image_name]
+
+                if pool is not None:
+                    in_flight[image_name] = pool.apply_async(remove_worker, (image_name,))
+                else:
+                    try:
+                        remove(pairs, model, delta_flux_model, image_name, delta_pixel, model_name, control, dtype)
+                        report(image_name, None)
+                    except Exception as error:
+                        report(image_name, "{}: {}".format(type(error).__name__, error))
+
+            wake.wait(interval)
+            wake.clear()
+
+        # graceful shutdown: the images given to the workers are finished
+        for image_name in in_flight:
+            name, error, records = in_flight[image_name].get()
+            pr.merge(records)
+            report(name, error)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if pool is not None:
+            pool.close()
+            pool.join()
+            del shared_model # the buffer must be released before closing the shared memory
+            shm.close()
+            shm.unlink()
+        for sig in handlers:
+            signal.signal(sig, handlers[sig])
+
+    print("\n{} images reduced, {} failed".format(len(done) - len(failed), len(failed)))
+    return failed
+
+# functions to keep the model, the pairs and delta_flux_model in a cache next to the model
+
+def save_array(file_name, array):
+    """saves an array in a .npy file safely: in a temporary file first, then renamed,
+    so that a process which has the old file memory-mapped keeps reading the old file"""
+    with open(file_name + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_name + '.tmp', file_name)
+
+def file_hash(file_name):
+    """returns the sha1 hash of the content of a file"""
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_cache(model_name, control, delta_pixel, verbose=False):
+    """loads the model, the control pairs and the delta_flux_model from the cache
+    saved next to the model (in the folder {model}_cache).
+    The cache is keyed by the hash of the model file, the hash of the pairs file and the box width,
+    it is built again when one of them changes.
+    The hashes are only computed again if the size or the modification time of the files changed.
+    The model of the cache is at full resolution, a preview model is expanded once here.
+
+    returns the pairs, the delta_flux_model and the model (float32, memory-mapped)"""
+
+    cache = model_name.split('.fits')[0] + '_cache'
+    key_name = os.path.join(cache, 'key.json')
+    box_width = 2 * delta_pixel + 1
+
+    signatures = {'model' : hi.file_signature(model_name), 'pairs' : hi.file_signature(control)}
+    files = {'model' : model_name, 'pairs' : control}
+
+    old = None
+    if os.path.exists(key_name):
+        with open(key_name, 'r') as f:
+            old = json.load(f)
+
+    hashes = {}
+    for name in files:
+        if (old is not None) and (old[name][:2] == signatures[name]):
+            hashes[name] = old[name][2] # the file was not touched
+        else:
+            hashes[name] = file_hash(files[name])
+    key = hashlib.sha1("{} {} {}".format(hashes['model'], hashes['pairs'], box_width).encode()).hexdigest()
+
+    entry = {'model' : signatures['model'] + [hashes['model']],
+             'pairs' : signatures['pairs'] + [hashes['pairs']],
+             'box width' : box_width,
+             'key' : key}
+
+    if (old is None) or (old['key'] != key):
+        if verbose:
+            print("building the cache of the model {}".format(model_name))
+        if not os.path.exists(cache):
+            os.mkdir(cache)
+
+        # the model is read and delta_flux_model computed only here
+        pairs = np.array(read_pairs(control))
+        delta_flux_model, model = delta_flux_ref(pairs, model_name, delta_pixel)
+        save_array(os.path.join(cache, 'model.npy'), model.astype(np.float32))
+        save_array(os.path.join(cache, 'pairs.npy'), pairs)
+        save_array(os.path.join(cache, 'delta_flux.npy'), delta_flux_model)
+    elif verbose:
+        print("using the cache of the model {}".format(model_name))
+
+    # the key is written last, so that an incomplete cache is never used
+    if old != entry:
+        with open(key_name + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(key_name + '.tmp', key_name)
+
+    pairs = np.load(os.path.join(cache, 'pairs.npy'))
+    delta_flux_model = np.load(os.path.join(cache, 'delta_flux.npy'))
+    model = np.load(os.path.join(cache, 'model.npy'), mmap_mode='r')
+
+    return pairs, delta_flux_model, model
+
+class ModelCache:
+    """keeps in memory the last models used (with their pairs and delta_flux_model), at most size models:
+    when a new model is needed and the cache is full, the model used the longest time ago is forgotten"""
+
+    def __init__(self, size, control, delta_pixel, cache=True, verbose=False):
+        self.size = size
+        self.control = control
+        self.delta_pixel = delta_pixel
+        self.cache = cache # if True, the models are loaded through their cache (see load_cache)
+        self.verbose = verbose
+        self.models = OrderedDict() # model name : (pairs, delta_flux_model, model), the most recent last
+
+    def get(self, model_name):
+        """returns the pairs, the delta_flux_model and the model of model_name, loaded if needed"""
+        if model_name in self.models:
+            self.models.move_to_end(model_name)
+            return self.models[model_name]
+
+        if len(self.models) >= self.size:
+            self.models.popitem(last=False)
+        if self.cache:
+            loaded = load_cache(model_name, self.control, self.delta_pixel, self.verbose)
+        else:
+            pairs = read_pairs(self.control)
+            loaded = (pairs,) + delta_flux_ref(pairs, model_name, self.delta_pixel)
+        self.models[model_name] = loaded
+        return loaded
+
+def remove_library(images, library, control, delta_pixel, workers=1, verbose=False, dtype=np.float32, cache=True,
+                   loaded_models=2, folder=None, read_ahead=2, writers=2):
+    """removes the fringing on all the images of the list images, each image with the best model
+    of the library (see model_library.py). The images are grouped by model, so that each model is loaded once,
+    and at most loaded_models models stay in memory.
+    folder : the folder of the images, to read their headers in its catalogue (see header_index.py).
+    read_ahead, writers : see remove_folder.
+
+    returns the list of the images which could not be reduced, with their error messages"""
+
+    groups, unmatched = ml.match_models(images, library, folder)
+    failed = [(image_name, "no model of the library has the shape of the image") for image_name in unmatched]
+    for image_name, error in failed:
+        print("{} could not be reduced : {}".format(image_name, error))
+
+    models = ModelCache(loaded_models, control, delta_pixel, cache, verbose)
+    for model_name in groups:
+        if verbose:
+            print("{} images reduced with the model {}".format(len(groups[model_name]), model_name))
+        pairs, delta_flux_model, model = models.get(model_name)
+        failed += remove_folder(groups[model_name], pairs, model, delta_flux_model, delta_pixel, model_name, control,
+                                workers, verbose, dtype, read_ahead, writers)
 
-    # subtraction of the model to the initial image
-    ratio = ratio_med(pairs, delta_flux_model, image, delta_pixel)
-    image = image - ratio * model
-    if pierside == 'WEST':
-        image = flip_image(image)
-    
-    # saving the new image
-    file_name = image_name.split(".fits")[0] + "_fringecor.fits"
-    ut.create_fits(file_name, image, header)
+    return failed
 
 # functions to correctly read the setup file
 
@@ -155,6 +649,17 @@ def read_int(num):
     """convert a string into an int"""
     return int(num)
 
+def read_bool(bool):
+    """reads a string bollean and returns the boolean associated"""
+    if bool == "True" or bool == "true":
+        return True
+    else:
+        return False
+
+def read_float(num):
+    """convert a string into a float"""
+    return float(num)
+
 def read_setup(file, verbose):
     """reads the setup file and returns the information in it"""
 
@@ -164,10 +669,20 @@ def read_setup(file, verbose):
     model_name = None
     control = None
     box_width = 11
+    workers = 1
+    cache = True
+    dtype = np.dtype(np.float32)
+    watch = False
+    interval = 2.
+    queue_size = 16
+    library = None
+    loaded_models = 2
+    read_ahead = 2
+    writers = 2
 
     # list of the default parameters
-    param_list = [image_name, folder_name, model_name, control, box_width]
-    pairs_file = None # to return the pairs file at the end for the history in the clean image header
+    param_list = [image_name, folder_name, model_name, control, box_width, workers, cache, dtype, watch, interval, queue_size,
+                  library, loaded_models, read_ahead, writers]
 
     # displays the default values if verbose
     if verbose:
@@ -177,17 +692,38 @@ def read_setup(file, verbose):
         print("- model name : {}".format(model_name))
         print("- control pairs : {}".format(control))
         print("- box width : {}".format(box_width))
+        print("- number of workers : {}".format(workers))
+        print("- model cache : {}".format(cache))
+        print("- dtype : {}".format(dtype))
+        print("- watch : {}".format(watch))
+        print("- poll interval : {}".format(interval))
+        print("- queue size : {}".format(queue_size))
+        print("- model library : {}".format(library))
+        print("- loaded models : {}".format(loaded_models))
+        print("- read ahead : {}".format(read_ahead))
+        print("- writer threads : {}".format(writers))
         print("\na message will be displayed each time a value is modified\n")
 
     # list of all the parameters accepted by the code
-    input_list = ['image name', 'folder name', 'model name', 'control pairs', 'box width']
+    input_list = ['image name', 'folder name', 'model name', 'control pairs', 'box width', 'number of workers', 'model cache', 'dtype',
+                  'watch', 'poll interval', 'queue size', 'model library', 'loaded models', 'read ahead', 'writer threads']
 
     # dictionnary with a function associated to each parameter if necessary to read them correctly
     input_dic = {'image name' : do_nothing,
                  'folder name': do_nothing,
                  'model name' : do_nothing,
-                 'control pairs' : read_pairs,
-                 'box width' : read_int
+                 'control pairs' : do_nothing, # the pairs are read with the model, through the cache
+                 'box width' : read_int,
+                 'number of workers' : read_int,
+                 'model cache' : read_bool,
+                 'dtype' : ut.read_dtype,
+                 'watch' : read_bool,
+                 'poll interval' : read_float,
+                 'queue size' : read_int,
+                 'model library' : do_nothing,
+                 'loaded models' : read_int,
+                 'read ahead' : read_int,
+                 'writer threads' : read_int
                  }
 
     # checking if there is a file
@@ -219,6 +755,7 @@ def read_setup(file, verbose):
             pass
 
     text.close() #closing the file
+    pairs_file = param_list[3] # to return the pairs file at the end for the history in the clean image header
     
     # errors
     if (param_list[0] is None) and (param_list[1] is None): # checks if a image name or a folder name was given
@@ -226,9 +763,9 @@ def read_setup(file, verbose):
         print("an image name (or a folder name) is needed to run the code.")
         print("Please give a setup file with atleast this piece of information")
         exit()
-    if param_list[2] is None: # checks the presence of a model name
+    if (param_list[2] is None) and ((param_list[11] is None) or param_list[8]): # checks the presence of a model name
         print("\nNO MODEL NAME GIVEN")
-        print("a model name is needed to run the code.")
+        print("a model name (or a model library, except in watch mode) is needed to run the code.")
         print("Please give a setup file with atleast this piece of information")
         exit()
     if param_list[3] is None: # checks the presence of control pairs
@@ -236,6 +773,11 @@ def read_setup(file, verbose):
         print("a control pairs file is needed to run the code.")
         print("Please give a setup file with atleast this piece of information")
         exit()
+    if param_list[8] and (param_list[1] is None): # checks the presence of a folder to watch
+        print("\nNO FOLDER NAME GIVEN")
+        print("the folder in which the images land is needed to run the code in watch mode.")
+        print("Please give a setup file with atleast this piece of information")
+        exit()
     
     # in the case where a foler name and an image name are both given in the setup file, the code choose the folder
     # in addition to the information in the folder, the code returns a boolean :
@@ -254,29 +796,47 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help="setup file needed to execute the code")
     parser.add_argument('-v', '--verbose', help="gives more information", action="store_true")
+    pr.add_arguments(parser)
     args = parser.parse_args()
     f_name = args.file
     verbose = args.verbose
+    pr.start(args.profile, args.cprofile, args.tracemalloc)
 
     # reading the setup file
-    (file_name, model_name, pairs, box_width), control, folder_check = read_setup(f_name, verbose)
+    ((file_name, model_name, control, box_width, workers, cache, dtype, watch, interval, queue_size, library, loaded_models,
+      read_ahead, writers), control, folder_check) = read_setup(f_name, verbose)
     
     # calculating the delta_pixel for the slices necessary to mean the values in the following functions
     delta_pixel = box_width // 2
     if verbose:
         print("the box width used is {} pixels".format(2*delta_pixel + 1))
 
-    # obtaining model and delta_flux_model east and west, depending on the images pierside
-    delta_flux_model, model = delta_flux_ref(pairs, model_name, delta_pixel)
+    # with a model library, each image is reduced with its best model
+    if (library is not None) and not watch:
+        images = glob.glob(os.path.join(file_name, '*.fits')) if folder_check else [file_name]
+        failed = remove_library(images, library, control, delta_pixel, workers, verbose, dtype, cache, loaded_models,
+                                file_name if folder_check else None, read_ahead, writers)
+        print("\n{} images reduced, {} failed".format(len(images) - len(failed), len(failed)))
+        exit()
+
+    # obtaining the pairs, the model and delta_flux_model, from the cache if it is up to date
+    # a preview model is expanded to the full resolution
+    if cache:
+        pairs, delta_flux_model, model = load_cache(model_name, control, delta_pixel, verbose)
+    else:
+        pairs = read_pairs(control)
+        delta_flux_model, model = delta_flux_ref(pairs, model_name, delta_pixel)
 
     # reducing the image or the images
-    if folder_check == False:
-        remove(pairs, model, delta_flux_model, file_name, delta_pixel, model_name, control)
+    if watch:
+        watch_folder(file_name, pairs, model, delta_flux_model, delta_pixel, model_name, control, workers, verbose, dtype,
+                     interval, queue_size)
+    elif folder_check == False:
+        remove(pairs, model, delta_flux_model, file_name, delta_pixel, model_name, control, dtype)
         if verbose:
             print("\n{} was succesfully reduced".format(file_name))
     else:    
-        images = glob.glob(file_name + "\\*.fits")
-        for im in images:
-            remove(pairs, model, delta_flux_model, im, delta_pixel, model_name, control)
-            if verbose:
-                print("{} reduced".format(im))
\ No newline at end of file
+        images = glob.glob(os.path.join(file_name, '*.fits'))
+        failed = remove_folder(images, pairs, model, delta_flux_model, delta_pixel, model_name, control, workers, verbose, dtype,
+                               read_ahead, writers)
+        print("\n{} images reduced, {} failed".format(len(images) - len(failed), len(failed)))
\ No newline at end of file
@@ -3,42 +3,36 @@
 import os
 import numpy as np
 from astropy.io import fits
-from random import shuffle
-import sys
-import glob
-import shutil
+import random
+import json
+import hashlib
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, shared_memory
+import header_index as hi
+import profiling as pr
 from astropy.stats import sigma_clipped_stats
 
 """gathers all the useful function for the code"""
 
-def pierside(image_name, path):
-    """check if the pierside of an image is East or West
-    if West, we rotate the image of 180°.
-    
-    image_name : string, the name of the .fits image.
-    At the end, it creates a new .fits file in the path indicated."""
-    
-    # we get the piece of information we want
-    with fits.open(image_name) as image:
+def load_image(image_name):
+    """lazily loads a .fits image with an 'EAST' pierside.
+    If the pierside of the image is West, the data returned is a view of the image
+    rotated of 180° (data[::-1, ::-1]), so that no copy of the image is made.
+
+    returns the data, the header, and a boolean which is True if the image was rotated"""
+
+    with fits.open(image_name, memmap=True) as image:
         data = image[0].data
-        shape = data.shape
         header = image[0].header
-        pierside = header['PIERSIDE']
-        pierside = pierside.strip()
-
-    name = image_name.split('\\')[-1]
-    name = path + '\\' + name.split('.fits')[0] + '_pierside.fits'
-    if pierside == 'WEST':
-        # then we rotate the image
-        data = data.flatten()
-        data = data[::-1] # rotation
-        data = np.reshape(data, shape)
-        # then we update the image file and write it in the history
-        header['PIERSIDE'] = 'EAST    '
-        header['HISTORY'] = "The image was returned to have an 'EAST' pierside"
 
-    create_fits(name, data, header) 
+    with pr.Stage('pierside handling'):
+        flipped = (header['PIERSIDE'].strip() == 'WEST')
+        if flipped:
+            data = data[::-1, ::-1] # rotation, only a view of the image
 
+    return data, header, flipped
 
 """the following functions are taken from the fringez code of
 https://authors.library.caltech.edu/109403/3/Medford_2021_PASP_133_064503.pdf, 
@@ -97,28 +91,650 @@ def update_fits(image_name,
             header = f[0].header # nothing is changed
 
     # Write the fits image to a temporary file
-    image_tmp = image_name.replace("fits", "fits.tmp")
+    image_tmp = image_name + ".tmp"
     fits.writeto(image_tmp,
                  data,
                  header,
                  overwrite=True)
 
-    # Remove the original image
-    if os.path.exists(image_name):
-        os.remove(image_name)
-
-    # Rename the temporary image name to the original image name
-    shutil.move(image_tmp, image_name)
+    # Rename the temporary image name to the original image name,
+    # the original image is replaced in one step
+    os.replace(image_tmp, image_name)
+
+def prefetch(function, items, depth=2, threads=1):
+    """yields (item, result, error) for each item of items, in order, where result = function(item)
+    is computed in advance by threads background threads, at most depth items ahead of the item yielded.
+    It is meant for reading files while the previous ones are processed.
+    error is None, or the exception raised by function (result is then None).
+    If depth is 0, function is called on each item when it is yielded, without threads."""
+
+    def call(item):
+        try:
+            return function(item), None
+        except Exception as error:
+            return None, error
+
+    if depth <= 0:
+        for item in items:
+            yield (item,) + call(item)
+        return
+
+    queue = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for item in items:
+            queue.append((item, executor.submit(call, item)))
+
+            # gives the oldest item when enough items are in advance
+            if len(queue) > depth:
+                item, future = queue.popleft()
+                yield (item,) + future.result()
+
+        while queue:
+            item, future = queue.popleft()
+            yield (item,) + future.result()
+
+def read_dtype(name):
+    """reads the name of a float type ('float32' or 'float64') and returns the numpy type"""
+    dtype = np.dtype(name.strip())
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("the type must be float32 or float64")
+    return dtype
+
+def row_bands(image_shape, n_layers, memory, itemsize=8):
+    """cuts an image with the shape image_shape in bands of rows so that
+    a stack of n_layers of these bands fits in the memory budget.
+
+    memory : the memory budget, in MB.
+    itemsize : the size in bytes of one pixel of the stack (4 for float32, 8 for float64).
+    returns a list of tuples (first_row, last_row), last_row excluded."""
+
+    n_rows, n_cols = image_shape
+
+    # np.median works on a copy of the stack, hence the factor 2
+    band_bytes = 2 * n_layers * n_cols * itemsize
+    rows = int(memory * 1024**2 // band_bytes)
+    rows = max(1, min(rows, n_rows)) # at least one row per band
+
+    return [(r, min(r + rows, n_rows)) for r in range(0, n_rows, rows)]
+
+def read_rows(image_name, first_row, last_row, flipped=False):
+    """reads only the rows first_row to last_row (excluded) of a .fits image,
+    without loading the rest of the image in memory.
+    If flipped is True, the rows are the ones of the image rotated of 180°"""
+    with pr.Stage('fits read') as stage, fits.open(image_name, memmap=True) as f:
+        if flipped:
+            n_rows = f[0].header['NAXIS2']
+            data = f[0].section[n_rows - last_row:n_rows - first_row]
+            data = data[::-1, ::-1]
+        else:
+            data = f[0].section[first_row:last_row]
+        stage.bytes_read = data.nbytes
+    return data
+
+def check_shape(data_shape, image_shape):
+    """raises ValueError if an image does not have the same shape as the others.
+    An exception (and not an exit) is needed in the worker processes, the pool sends it back to the main process"""
+    if data_shape != image_shape:
+        raise ValueError('%s != %s : ** ALL IMAGES MUST BE THE SAME SIZE **' % (str(data_shape), str(image_shape)))
+
+def binned_shape(image_shape, binning=1):
+    """gives the shape of an image of shape image_shape binned binning x binning.
+    The binning must divide the shape of the image"""
+    if (image_shape[0] % binning != 0) or (image_shape[1] % binning != 0):
+        raise ValueError("the binning {} does not divide the shape of the images {}".format(binning, tuple(image_shape)))
+    return (image_shape[0] // binning, image_shape[1] // binning)
+
+def bin_image(data, binning=1):
+    """returns the image binned binning x binning: each pixel is the mean of a block of binning x binning pixels.
+    returns the image itself if binning is 1"""
+    if binning == 1:
+        return data
+    n_rows, n_cols = binned_shape(data.shape, binning)
+    return data.reshape(n_rows, binning, n_cols, binning).mean(axis=(1, 3))
+
+def expand_image(data, binning=1):
+    """returns a binned image back at full resolution: each pixel becomes a block of binning x binning pixels"""
+    if binning == 1:
+        return data
+    return np.repeat(np.repeat(data, binning, axis=0), binning, axis=1)
+
+def normalized_sample(fringe_filenames, image_shape, memory=None, out=None, dtype=np.float32, read_ahead=2, sky='median',
+                      binning=1):
+    """normalizes each image of a sample by its median, and returns
+    the median of the sample. The images are all turned to the 'EAST' pierside.
+
+    fringe_filenames : the names of the images of the sample.
+    memory : memory budget in MB. If None, the whole sample is loaded at once,
+    else the median of the sample is done band of rows by band of rows,
+    reading only the rows needed in each image.
+    out : array in which the median of the sample is written, if given.
+    dtype : the type of the stack of images and of the median.
+    read_ahead : number of images (or bands of images) read in advance by background threads
+    while the previous ones are normalized (see prefetch), 0 to read them one after the other.
+    With a memory budget, read_ahead + 1 images are in memory while the medians of the images are taken.
+    sky : the estimator of the sky level subtracted to each image, see sky_level.
+    binning : the images are binned binning x binning as they are read (see bin_image),
+    the median of the sample has the shape binned_shape(image_shape, binning)."""
+
+    n_images = len(fringe_filenames)
+    sample_shape = binned_shape(image_shape, binning)
+
+    if out is None:
+        out = np.zeros(sample_shape, dtype=dtype)
+
+    if memory is None:
+        sample = np.zeros((n_images, sample_shape[0], sample_shape[1]), dtype=dtype)
+
+        def read_layer(i):
+            # gets the image, read directly in the sample
+            with pr.Stage('fits read') as stage:
+                data_fringe = load_image(fringe_filenames[i])[0]
+
+                # checks the size of the image
+                check_shape(data_fringe.shape, image_shape)
+                sample[i] = bin_image(data_fringe, binning)
+                stage.bytes_read = data_fringe.nbytes
+
+        # the next images are read while an image is normalized
+        for i, result, error in prefetch(read_layer, range(n_images), read_ahead, max(1, read_ahead)):
+            if error is not None:
+                raise error
 
-def gather_normalized_images(file, N_samples=None):
-    """gather all the images, centers them, and send them in "file"
+            # generates the normalized image
+            with pr.Stage('normalization median'):
+                sample[i] -= sky_level(sample[i], sky)
+
+        # takes the median of the sample
+        with pr.Stage('stack median'):
+            out[:] = np.median(sample, axis=0)
+        return out
+
+    def read_image(fringe_filename):
+        with pr.Stage('fits read') as stage:
+            data_fringe, header, flipped = load_image(fringe_filename)
+            check_shape(data_fringe.shape, image_shape)
+            data_fringe = np.array(data_fringe) # the image is read here, not while taking its median
+            stage.bytes_read = data_fringe.nbytes
+        return bin_image(data_fringe, binning), flipped
+
+    # first, the median of each image, only read_ahead + 1 images are in memory at a time
+    medians = []
+    flips = []
+    for fringe_filename, loaded, error in prefetch(read_image, fringe_filenames, read_ahead, max(1, read_ahead)):
+        if error is not None:
+            raise error
+        data_fringe, flipped = loaded
+        with pr.Stage('normalization median'):
+            if sky == 'median': # the image is not used after, the median can reorder it
+                medians.append(np.median(data_fringe, overwrite_input=True))
+            else:
+                medians.append(sky_level(data_fringe, sky))
+        flips.append(flipped)
+        del data_fringe, loaded
+
+    # then the median of the sample, band by band
+    for first_row, last_row in row_bands(sample_shape, n_images, memory, np.dtype(dtype).itemsize):
+        band = np.zeros((n_images, last_row - first_row, sample_shape[1]), dtype=dtype)
+
+        def read_band(i):
+            rows = read_rows(fringe_filenames[i], first_row * binning, last_row * binning, flips[i])
+            rows = bin_image(rows, binning)
+            rows -= medians[i] # same normalization as for the whole image
+            band[i] = rows
+
+        # the rows of the images are read by several threads at the same time
+        for i, result, error in prefetch(read_band, range(n_images), read_ahead, max(1, read_ahead)):
+            if error is not None:
+                raise error
+        with pr.Stage('stack median'):
+            out[first_row:last_row] = np.median(band, axis=0)
+        del band
+
+    return out
+
+# estimators of the sky level of an image, to normalize the images
+
+SKY_ESTIMATORS = ['median', 'subsample', 'histogram', 'sigma_clip']
+
+def subsample(data, n_pixels=2**16):
+    """returns about n_pixels pixels of an image, taken on a regular grid (data[::step, ::step]).
+    The grid is used rather than random pixels so that the models can be made again identically"""
+    step = max(1, int(np.sqrt(data.size / n_pixels)))
+    return data[::step, ::step]
+
+def histogram_mode(values):
+    """returns the mode of values: the peak of their histogram (bins of a quarter of the robust standard
+    deviation over +- 3 standard deviations around the median), refined with a parabola through the peak bin
+    and its neighbours"""
+    values = values.ravel()
+    median = np.median(values)
+    sigma = 1.4826 * np.median(np.abs(values - median)) # robust standard deviation
+    if sigma == 0:
+        return median
+    counts, edges = np.histogram(values, bins=24, range=(median - 3 * sigma, median + 3 * sigma))
+    peak = np.argmax(counts)
+    shift = 0.
+    if 0 < peak < len(counts) - 1:
+        curvature = counts[peak - 1] - 2 * counts[peak] + counts[peak + 1]
+        if curvature != 0:
+            shift = 0.5 * (counts[peak - 1] - counts[peak + 1]) / curvature
+    return edges[peak] + (0.5 + shift) * (edges[1] - edges[0])
+
+def sky_level(data, method='median', n_pixels=2**16):
+    """estimates the sky level of an image, which is subtracted to normalize it.
+
+    method :
+    - 'median' : the median of all the pixels (exact, but a partition of the whole image).
+    - 'subsample' : the median of about n_pixels pixels on a regular grid (see subsample).
+      For a sky of pixel noise sigma, the error on the median is about 1.25 * sigma / sqrt(n_pixels),
+      0.005 sigma with the 65536 pixels by default, and it runs 50 to 100 times faster on a 2048x2048 image.
+    - 'histogram' : the mode of the histogram of the subsample (see histogram_mode), the most frequent sky value,
+      less sensitive to the stars than the median. Its noise is a few 0.01 sigma, it runs ~15 times faster.
+      Fringes stronger than the noise give the histogram two peaks (crests and troughs), use it for faint fringes only.
+    - 'sigma_clip' : the median of the subsample once the pixels beyond 3 sigma (stars, cosmic rays) are removed
+      (astropy sigma_clipped_stats). Same noise as 'subsample', it runs ~7 times faster.
+
+    The model is the median of the samples, whose pixels are medians of the normalized images, so if the levels
+    of all the images are off by at most e, each pixel of the model is off by at most e from the model made
+    with the same levels. 'subsample' therefore keeps the model within a few 0.01 sigma of the exact-median model.
+    'histogram' and 'sigma_clip' estimate the sky under the stars, lower than the median by a fraction of sigma
+    depending on the number of stars: their models differ from the exact-median model by about this offset,
+    which is nearly the same everywhere and cancels in the flux variations of the control pairs."""
+
+    if method == 'median':
+        return np.median(data)
+    values = subsample(data, n_pixels)
+    if method == 'subsample':
+        return np.median(values)
+    if method == 'histogram':
+        return histogram_mode(values)
+    if method == 'sigma_clip':
+        return sigma_clipped_stats(values, sigma=3, maxiters=5)[1]
+    raise ValueError("the sky estimator must be one of {}".format(', '.join(SKY_ESTIMATORS)))
+
+def read_sky(name):
+    """reads the name of a sky estimator (see sky_level)"""
+    name = name.strip()
+    if name not in SKY_ESTIMATORS:
+        raise ValueError("the sky estimator must be one of {}".format(', '.join(SKY_ESTIMATORS)))
+    return name
+
+class StreamingMedian:
+    """approximate median, pixel by pixel, of images added one by one, in a memory which does not depend
+    on the number of images: each image is counted in a histogram of each pixel and then forgotten.
+
+    The first warmup images are kept to place the histogram of each pixel: bins bins over
+    +- span robust standard deviations of the warmup images around their median. The median is then found
+    in the histogram, interpolated linearly in its bin, so that each pixel is within one bin width,
+    2 * span * sigma / bins, of the exact median (sigma : spread of the pixel among the images).
+    The pixels whose median falls outside the histogram (see n_outside) are set to the edge of the histogram.
+    With at most warmup images, the median is exact.
+
+    The histogram takes (bins + 2) * 2 bytes per pixel (4 bytes beyond 65535 images),
+    against 4 bytes per pixel and per image (float32) for the exact median."""
+
+    def __init__(self, image_shape, bins=64, n_images=None, warmup=9, span=4.):
+        self.image_shape = tuple(image_shape)
+        self.bins = bins
+        self.warmup = warmup
+        self.span = span
+        self.count_type = np.uint16 if (n_images is not None) and (n_images < 2**16) else np.uint32
+        self.buffer = []
+        self.counts = None
+        self.n_images = 0
+        self.n_outside = 0
+
+    def place_bins(self):
+        """places the histogram of each pixel with the warmup images, and counts them"""
+        buffer = np.array(self.buffer, dtype=np.float32)
+        self.buffer = []
+        center = np.median(buffer, axis=0)
+        sigma = 1.4826 * np.median(np.abs(buffer - center), axis=0)
+        # a few warmup images can give a pixel a much too small spread, it gets at least the typical spread of the image
+        positive = sigma[sigma > 0]
+        sigma = np.maximum(sigma, np.median(positive) if len(positive) > 0 else 1.)
+        self.width = (2 * self.span * sigma / self.bins).astype(np.float32)
+        self.low = (center - self.span * sigma).astype(np.float32)
+        self.counts = np.zeros((self.bins + 2,) + self.image_shape, dtype=self.count_type)
+        for image in buffer:
+            self.count(image)
+
+    def count(self, image):
+        """adds an image to the histograms. Bin 0 counts the values under the histogram, bin bins + 1 over it"""
+        index = np.floor((image - self.low) / self.width)
+        index = np.clip(index, -1, self.bins).astype(np.intp) + 1
+        n_pixels = index.size
+        flat = self.counts.reshape(self.bins + 2, n_pixels)
+        flat[index.ravel(), np.arange(n_pixels)] += 1
+
+    def add(self, image):
+        """adds an image (its values are copied, the image can be reused)"""
+        check_shape(image.shape, self.image_shape)
+        self.n_images += 1
+        if self.counts is None:
+            self.buffer.append(np.array(image, dtype=np.float32))
+            if len(self.buffer) > self.warmup:
+                self.place_bins()
+        else:
+            self.count(image)
+
+    def rank_value(self, rank):
+        """returns the approximate value of rank rank (1 for the smallest) of each pixel:
+        the c values counted in a bin are taken evenly spread in it, at (k - 0.5) / c of the bin"""
+        value = np.zeros(self.image_shape, dtype=np.float32)
+        done = np.zeros(self.image_shape, dtype=bool)
+        below = np.zeros(self.image_shape, dtype=np.int64) # number of values in the bins before
+        n_outside = 0
+        for b in range(self.bins + 2):
+            counts = self.counts[b]
+            found = ~done & (below + counts >= rank)
+            if b == 0:
+                value[found] = self.low[found]
+            elif b == self.bins + 1:
+                value[found] = self.low[found] + self.bins * self.width[found]
+            else:
+                fraction = (rank - below[found] - 0.5) / counts[found]
+                value[found] = self.low[found] + (b - 1 + fraction) * self.width[found]
+            if b in (0, self.bins + 1):
+                n_outside += int(np.count_nonzero(found))
+            done |= found
+            below += counts
+        return value, n_outside
+
+    def median(self):
+        """returns the approximate median of the images added so far,
+        the mean of the two middle values for an even number of images, as np.median"""
+        if self.counts is None:
+            return np.median(np.array(self.buffer), axis=0)
+
+        low_rank, high_rank = (self.n_images + 1) // 2, self.n_images // 2 + 1
+        median, self.n_outside = self.rank_value(low_rank)
+        if high_rank != low_rank:
+            high_value, n_outside = self.rank_value(high_rank)
+            median = (median + high_value) / 2
+            self.n_outside = max(self.n_outside, n_outside)
+        return median
+
+def fit_bins(bins, map_shape, n_images, memory=None):
+    """fits the histograms of a StreamingMedian of n_images images in the memory budget (MB):
+    they take at most half of it, with fewer bins if needed, and the samples take the rest.
+    returns the number of bins and the memory left for the samples (None without a budget)"""
+    if memory is None:
+        return bins, None
+    itemsize = 2 if n_images < 2**16 else 4
+    pixel_mb = itemsize * int(np.prod(map_shape)) / 1024**2 # one bin of the histograms of all the pixels
+    max_bins = int(memory / 2 / pixel_mb) - 2
+    if max_bins < 4:
+        raise ValueError('%i MB : ** THE MEMORY BUDGET IS TOO SMALL FOR THE HISTOGRAMS OF THE STREAMING MEDIAN **' % memory)
+    if bins > max_bins:
+        print('the histograms of %i bins do not fit in half of the memory budget, %i bins are used' % (bins, max_bins))
+        bins = max_bins
+    return bins, memory - (bins + 2) * pixel_mb
+
+def median_combine(stack, memory=None, bins=None):
+    """returns the median along the first axis of a stack of images (list or array).
+    If memory (in MB) is given, the median is done band of rows by band of rows,
+    so that a memory-mapped stack is never loaded entirely in memory.
+    If bins is given, the median is approximated with a histogram of bins bins (see StreamingMedian),
+    reading the images of the stack one by one.
+    The stack can also be a StreamingMedian to which the images were already added."""
+
+    if isinstance(stack, StreamingMedian):
+        return stack.median()
+    if bins is not None:
+        stream = StreamingMedian(stack[0].shape, bins, len(stack))
+        for layer in stack:
+            stream.add(layer)
+        return stream.median().astype(stack[0].dtype, copy=False)
+
+    if memory is None:
+        return np.median(stack, axis=0)
+
+    n_layers = len(stack)
+    image_shape = stack[0].shape
+    dtype = stack[0].dtype
+    median = np.zeros(image_shape, dtype=dtype)
+    for first_row, last_row in row_bands(image_shape, n_layers, memory, dtype.itemsize):
+        band = [layer[first_row:last_row] for layer in stack]
+        median[first_row:last_row] = np.median(band, axis=0)
+        del band
+
+    return median
+
+def sample_worker(task):
+    """makes one sample of gather_normalized_images in a worker process.
+    The median of the sample is written directly in the fringe map of index id_sample,
+    either in a shared memory block (shm_name, the slots of SampleSlots) or in a memory-mapped .npy file (maps_name),
+    so that the big arrays are never sent back through the pool.
+    If both are None, the median of the sample is sent back (to be added to a StreamingMedian).
+
+    returns the id of the sample done, its median (None if it was written in the fringe maps)
+    and the measures of its stages (see profiling.take)"""
+
+    id_sample, fringe_filenames, image_shape, memory, maps_shape, shm_name, maps_name, dtype, read_ahead, sky, binning = task
+
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        fringe_maps = np.ndarray(maps_shape, dtype=dtype, buffer=shm.buf)
+        normalized_sample(fringe_filenames, image_shape, memory, fringe_maps[id_sample], dtype, read_ahead, sky, binning)
+        del fringe_maps # the buffer must be released before closing the shared memory
+        shm.close()
+    elif maps_name is None:
+        sample = normalized_sample(fringe_filenames, image_shape, memory, None, dtype, read_ahead, sky, binning)
+        return id_sample, sample, pr.take()
+    else:
+        fringe_maps = np.load(maps_name, mmap_mode='r+')
+        normalized_sample(fringe_filenames, image_shape, memory, fringe_maps[id_sample], dtype, read_ahead, sky, binning)
+        fringe_maps.flush()
+        del fringe_maps
+
+    return id_sample, None, pr.take()
+
+class SampleSlots:
+    """a shared memory block of a few fringe maps (the slots), through which the worker processes send back
+    the samples kept in memory (see run_sample_tasks). A slot is used again as soon as the main process
+    took its sample, so the block does not depend on the number of samples. close frees the block"""
+
+    def __init__(self, n_slots, map_shape, dtype=np.float32):
+        self.shape = (n_slots,) + tuple(map_shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.dtype.itemsize * int(np.prod(self.shape)))
+        self.maps = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.free = list(range(n_slots))
+
+    def close(self):
+        """frees the shared memory block"""
+        self.maps = None # the buffer must be released before closing the shared memory
+        self.shm.close()
+        self.shm.unlink()
+
+def start_pool(workers):
+    """starts a pool of workers processes making samples (see sample_worker)"""
+    return Pool(workers, initializer=pr.init_worker, initargs=(pr.enabled,))
+
+def run_sample_tasks(tasks, workers=1, stream=None, done=None, slots=None, out=None, pool=None):
+    """makes the samples described by tasks (see sample_worker),
+    in a pool of workers processes if workers > 1.
+    pool : the pool to use (see start_pool), kept open for the next tasks. If None, a pool is started for these tasks only.
+    stream : a StreamingMedian to which the medians of the samples sent back are added.
+    done : function called with the id of each sample done, once its fringe map is written
+    slots : with workers > 1, the SampleSlots through which the samples of the tasks are sent back,
+    to be added to stream, or else copied in out[id of the sample], for the fringe maps kept in memory"""
+
+    n_tasks = len(tasks)
+    if n_tasks == 0: # e. g. all the samples are in the checkpoint, no pool is started for nothing
+        return
+
+    if (workers > 1) and (slots is not None):
+        # each task writes its sample in a free slot, the slots are taken back in the order of the tasks
+        # (a StreamingMedian places its histograms with the first samples)
+        with start_pool(workers) if pool is None else nullcontext(pool) as pool:
+            pending = deque()
+            n_done = 0
+
+            def take_back():
+                nonlocal n_done
+                id_sample, slot, result = pending.popleft()
+                pr.merge(result.get()[2])
+                if stream is not None:
+                    stream.add(slots.maps[slot])
+                else:
+                    out[id_sample] = slots.maps[slot]
+                slots.free.append(slot)
+                if done is not None:
+                    done(id_sample)
+                if n_done % 10 == 0:
+                    print('Generating fringe sample %i/%i' % (n_done, n_tasks))
+                n_done += 1
+
+            for task in tasks:
+                if len(slots.free) == 0:
+                    take_back()
+                slot = slots.free.pop()
+                slot_task = (slot,) + tuple(task[1:4]) + (slots.shape, slots.shm.name, None) + tuple(task[7:])
+                pending.append((task[0], slot, pool.apply_async(sample_worker, (slot_task,))))
+            while pending:
+                take_back()
+
+    elif workers > 1:
+        # the samples are independent, so they are done in any order,
+        # except for a StreamingMedian, whose histograms are placed with the first samples
+        with start_pool(workers) if pool is None else nullcontext(pool) as pool:
+            results = pool.imap_unordered(sample_worker, tasks) if stream is None else pool.imap(sample_worker, tasks)
+            for n_done, (id_sample, sample, records) in enumerate(results):
+                pr.merge(records)
+                if sample is not None:
+                    stream.add(sample)
+                if done is not None:
+                    done(id_sample)
+                if n_done % 10 == 0:
+                    print('Generating fringe sample %i/%i' % (n_done, n_tasks))
+    else:
+        for n_done, task in enumerate(tasks):
+            if n_done % 10 == 0:
+                print('Generating fringe sample %i/%i' % (n_done, n_tasks))
+            id_sample, sample, records = sample_worker(task)
+            pr.merge(records)
+            if sample is not None:
+                stream.add(sample)
+            if done is not None:
+                done(id_sample)
+
+def shard_samples(N_samples, shard=None):
+    """returns the ids of the samples made by a shard (index, number of shards) of the model:
+    the samples whose id modulo the number of shards is the index. All the samples if shard is None"""
+    if shard is None:
+        return list(range(N_samples))
+    index, n_shards = shard
+    return list(range(index, N_samples, n_shards))
+
+def open_checkpoint(checkpoint, images, N_samples, seed, image_shape, dtype=np.float32, sky='median', shard=None, binning=1):
+    """opens the checkpoint (a folder) of gather_normalized_images, or starts it if there is none.
+
+    The checkpoint keeps the fringe map of each sample done (checkpoint/fringe_maps.npy),
+    in checkpoint/checkpoint.json, written once, the shuffled images with their size and modification time,
+    the seed and the parameters of the samples, and in checkpoint/done.jsonl one line per sample done.
+    If the checkpoint was made with the same images and parameters, the images are taken in the order recorded,
+    so that each sample gets the same images, and the samples done are not made again.
+    Else the checkpoint is started again.
+    shard : the shard of the samples made (see shard_samples), the checkpoint only keeps its fringe maps.
+    binning : the binning of the images (see normalized_sample), image_shape is the shape of the binned images.
+
+    returns the images in the order of the checkpoint, the set of the samples done, the name of the fringe maps
+    and a function recording that a sample is done, to call once its fringe map is written"""
+
+    if not os.path.exists(checkpoint):
+        os.mkdir(checkpoint)
+    info_name = os.path.join(checkpoint, 'checkpoint.json')
+    maps_name = os.path.join(checkpoint, 'fringe_maps.npy')
+    done_name = os.path.join(checkpoint, 'done.jsonl')
+
+    signatures = {name : hi.file_signature(name) for name in images}
+    parameters = {'N_samples' : N_samples, 'image shape' : list(image_shape), 'dtype' : np.dtype(dtype).name, 'sky' : sky,
+                  'shard' : None if shard is None else list(shard), 'binning' : binning}
+    n_maps = len(shard_samples(N_samples, shard))
+
+    info = None
+    if os.path.exists(info_name) and os.path.exists(maps_name):
+        with open(info_name, 'r') as f:
+            info = json.load(f)
+        if ((info['parameters'] != parameters) or (info['signatures'] != signatures)
+                or ((seed is not None) and (info['seed'] != seed))):
+            print('the images or the parameters changed since the checkpoint, all the samples are made again')
+            info = None
+
+    if info is None:
+        # the list of the samples done is emptied first, and the information written last,
+        # so that an interrupted start is never taken for a checkpoint
+        open(done_name, 'w').close()
+        info = {'seed' : seed, 'parameters' : parameters, 'images' : [str(name) for name in images],
+                'signatures' : signatures}
+        fringe_maps = np.lib.format.open_memmap(maps_name, mode='w+', dtype=dtype,
+                                                shape=(n_maps, image_shape[0], image_shape[1]))
+        del fringe_maps
+        write_store_info(info_name, info)
+        done = set()
+    else:
+        done = set(read_records(done_name))
+        print('resuming from the checkpoint : %i samples of %i already done' % (len(done), n_maps))
+
+    def mark_done(id_sample):
+        append_record(done_name, int(id_sample))
+
+    return np.array(info['images']), done, maps_name, mark_done
+
+def model_change(model, previous):
+    """returns the RMS of the change of a model since the previous one, relative to the RMS of the model"""
+    rms = np.sqrt(np.mean(np.square(model, dtype=np.float64)))
+    if rms == 0:
+        return 0.
+    return np.sqrt(np.mean(np.square(model - previous, dtype=np.float64))) / rms
+
+def catalogue_shape(file, image_name):
+    """gives the shape of an image of the folder file, from the catalogue of the headers"""
+    info = hi.header_info(file, image_name)
+    return (info['naxis2'], info['naxis1'])
+
+def gather_normalized_images(file, N_samples=None, memory=None, maps_name=None, workers=1, seed=None, dtype=np.float32,
+                             selection=None, read_ahead=2, sky='median', bins=None, checkpoint=None, shard=None,
+                             tolerance=None, step=10, binning=1):
+    """gather all the images, centers them, and makes the fringe maps with them
     
     N_samples : number of samples for the model.
     if N_samples = None, then N_samples = N_images
-    file : file in which the images gathered will be moved"""
-
-    # gets all the images
-    fringe_filename_arr = glob.glob(file + '\\*.fits')
+    file : folder in which the images are taken. The images with a 'WEST' pierside
+    are rotated on the fly, no rotated copy of them is needed
+    memory : memory budget in MB. If given, the samples are made band by band
+    and the fringe maps are written in a memory-mapped .npy file, maps_name,
+    so that the memory used does not depend on the number of images or samples.
+    workers : number of processes making the samples at the same time.
+    seed : seed of the shuffling of the images, to always get the same samples.
+    dtype : the type of the samples and of the fringe maps (float32 halves the memory used).
+    selection : dictionary of conditions on the images (band, pierside, date1, date2...), see header_index.select_images.
+    read_ahead : number of images read in advance in each sample, see normalized_sample.
+    sky : the estimator of the sky level subtracted to each image, see sky_level.
+    bins : if given, the median of each sample is added to a StreamingMedian with bins bins as soon as it is made,
+    and then forgotten, so that the memory does not depend on the number of samples.
+    With a memory budget, the histograms take at most half of it (with fewer bins if needed, see fit_bins).
+    This StreamingMedian is returned instead of the fringe maps (median_combine takes it as it is).
+    checkpoint : a folder in which the fringe map of each sample is kept as soon as it is done (see open_checkpoint),
+    so that an interrupted run starts again from the samples done. The fringe maps are then memory-mapped
+    from the checkpoint, and bins is not used here (median_combine can still take the median with bins).
+    shard : (index, number of shards), to make only the samples of a shard (see shard_samples).
+    All the shards must use the same seed, so that they share the same samples.
+    tolerance : if given, the samples are made by batches of step samples. After each batch, the model is made
+    with the samples done (median_combine) and compared to the model of the previous batch (see model_change):
+    when it changed by less than tolerance after two batches in a row, no more samples are made.
+    binning : the images are binned binning x binning as they are read (see normalized_sample), for a quick preview model:
+    the fringe maps are binning**2 times smaller. As each sample takes its images
+    all over the shuffled images, the images of the samples not made are never read.
+
+    returns the fringe maps (of the samples of the shard, in the order of their ids) and their number"""
+
+    # gets all the images from the catalogue of the headers of the folder, sorted so that the shuffling only depends on the seed
+    if selection is None:
+        selection = {}
+    fringe_filename_arr = hi.select_images(file, **selection)
 
     # we convert fringe_file_arr in an array
     fringe_filename_arr = np.array(fringe_filename_arr)
@@ -126,11 +742,10 @@ def gather_normalized_images(file, N_samples=None):
 
     # shuffling in order to have diversity in a sample
     # in case N_sample != N_images
-    shuffle(fringe_filename_arr)
+    random.Random(seed).shuffle(fringe_filename_arr)
       
     # Determines the image_shape
-    with fits.open(fringe_filename_arr[0]) as f:
-        image_shape = f[0].data.shape
+    image_shape = catalogue_shape(file, fringe_filename_arr[0])
 
     # Calculates the size of the samples
 
@@ -143,44 +758,248 @@ def gather_normalized_images(file, N_samples=None):
                                                                       N_samples,
                                                                       N_images_per_sample))
 
-    fringe_maps = []
-
-    # processing of each sample
-    for id_sample in range(N_samples):
-
-        if id_sample % 10 == 0:
-            print('Generating fringe sample %i/%i' % (id_sample, N_samples))
-
-        # creation of a sample
-        my_idx_sample = np.arange(id_sample, N_images, N_samples).astype(int) 
-
-        sample = np.zeros((len(my_idx_sample), image_shape[0], image_shape[1]))
-
-        for i, idx in enumerate(my_idx_sample):
-            # gets the image
-            fringe_filename = fringe_filename_arr[idx]
-            with fits.open(fringe_filename) as f:
-                data_fringe = f[0].data
+    # the samples made, the fringe map of the i-th one is fringe_maps[i]
+    ids = shard_samples(N_samples, shard)
+    map_shape = binned_shape(image_shape, binning)
+    maps_shape = (len(ids), map_shape[0], map_shape[1])
+    slots = None
+    done = set() # the samples already in the checkpoint
+    mark_done = None
+
+    if checkpoint is not None:
+        # the images keep the order of the checkpoint, and the fringe maps are on the disk
+        fringe_filename_arr, done, maps_name, mark_done = open_checkpoint(checkpoint, fringe_filename_arr, N_samples, seed,
+                                                                           map_shape, dtype, sky, shard, binning)
+        fringe_maps = np.load(maps_name, mmap_mode='r+')
+    elif bins is not None:
+        # the fringe maps are not kept, only their histograms, which take a part of the memory budget,
+        # and the workers send the samples back through a few slots of shared memory
+        bins, memory = fit_bins(bins, map_shape, len(ids), memory)
+        fringe_maps = StreamingMedian(map_shape, bins, len(ids))
+        maps_name = None
+        if (workers > 1) and (len(ids) > 0):
+            slots = SampleSlots(2 * workers, map_shape, dtype)
+    elif memory is not None:
+        # the fringe maps stay on the disk
+        fringe_maps = np.lib.format.open_memmap(maps_name, mode='w+', dtype=dtype, shape=maps_shape)
+        fringe_maps.flush() # the workers open the file themselves
+    elif (workers > 1) and (len(ids) > 0): # a shard can have no sample when there are more shards than samples
+        # the fringe maps are in memory, the workers send them back through a few slots of shared memory
+        fringe_maps = np.zeros(maps_shape, dtype=dtype)
+        slots = SampleSlots(2 * workers, map_shape, dtype)
+    else:
+        fringe_maps = []
+
+    # with a tolerance, the samples are made by batches of step samples (at least one per worker),
+    # and no more samples are made once the model does not change anymore
+    step = max(1, len(ids)) if tolerance is None else max(1, step, workers) # a shard can have no sample
+    n_made = len(ids)
+    previous = None
+    n_converged = 0 # number of successive batches which did not change the model
+    stream = fringe_maps if isinstance(fringe_maps, StreamingMedian) else None
+
+    # the workers are started once for all the batches,
+    # and they are stopped and the shared memory block is freed even if a sample fails
+    pool = None
+    try:
+        if (workers > 1) and (len(done) < len(ids)):
+            pool = start_pool(workers)
+        for first in range(0, len(ids), step):
+            batch = range(first, min(first + step, len(ids)))
+
+            if workers > 1:
+                tasks = []
+                for i in batch:
+                    if i in done:
+                        continue
+                    my_idx_sample = np.arange(ids[i], N_images, N_samples).astype(int)
+                    tasks.append((i, fringe_filename_arr[my_idx_sample], image_shape, memory,
+                                  maps_shape, None, maps_name, dtype, read_ahead, sky, binning))
+
+                run_sample_tasks(tasks, workers, stream, mark_done, slots, fringe_maps, pool)
+            else:
+                # processing of each sample
+                for i in batch:
+
+                    if i in done:
+                        continue
+                    if i % 10 == 0:
+                        print('Generating fringe sample %i/%i' % (i, len(ids)))
+
+                    # creation of a sample
+                    my_idx_sample = np.arange(ids[i], N_images, N_samples).astype(int)
+
+                    # takes the median of the sample and then put i in fringe_maps
+                    if stream is not None:
+                        sample_median = normalized_sample(fringe_filename_arr[my_idx_sample], image_shape, memory, None, dtype, read_ahead, sky,
+                                                          binning)
+                        fringe_maps.add(sample_median)
+                    elif (memory is None) and (checkpoint is None):
+                        sample_median = normalized_sample(fringe_filename_arr[my_idx_sample], image_shape, dtype=dtype, read_ahead=read_ahead, sky=sky,
+                                                          binning=binning)
+                        fringe_maps.append(sample_median)
+                    else:
+                        normalized_sample(fringe_filename_arr[my_idx_sample], image_shape, memory, fringe_maps[i], dtype, read_ahead, sky, binning)
+                        if mark_done is not None:
+                            fringe_maps.flush()
+                            mark_done(i)
+
+            if (tolerance is not None) and (batch.stop < len(ids)):
+                with pr.Stage('convergence check'):
+                    model = stream.median() if stream is not None else median_combine(fringe_maps[:batch.stop], memory)
+                if previous is not None:
+                    change = model_change(model, previous)
+                    print('%i samples : the model changed by %.4f of its RMS' % (batch.stop, change))
+                    n_converged = n_converged + 1 if change < tolerance else 0
+                    if n_converged == 2:
+                        print('the model converged, the last %i samples are not made' % (len(ids) - batch.stop))
+                        n_made = batch.stop
+                        break
+                previous = model
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if slots is not None:
+            slots.close()
+
+    if stream is None:
+        fringe_maps = fringe_maps[:n_made]
+
+    if isinstance(fringe_maps, np.memmap):
+        fringe_maps.flush()
+
+    return fringe_maps, n_made
+
+# functions to keep the fringe maps in a store, so that the model can be updated with new images
+
+def store_sample_id(image_name, N_samples):
+    """gives the sample in which an image goes in a model store.
+    It only depends on the name of the image, so that adding or removing
+    images does not change the samples of the other images"""
+    name = os.path.basename(image_name)
+    return int(hashlib.md5(name.encode()).hexdigest(), 16) % N_samples
+
+def write_store_info(info_name, info):
+    """writes the information of a model store, safely (temporary file then renaming)"""
+    with open(info_name + '.tmp', 'w') as f:
+        json.dump(info, f)
+    os.replace(info_name + '.tmp', info_name)
+
+def append_record(log_name, record):
+    """appends a record (one line of JSON) at the end of a log file.
+    Only this line is written, whatever the size of the information kept next to the log"""
+    with open(log_name, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_records(log_name):
+    """returns the records of a log file (see append_record), [] if there is none.
+    A last line cut by an interruption is ignored"""
+    if not os.path.exists(log_name):
+        return []
+    with open(log_name, 'r') as f:
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+def update_model_store(file, store, N_samples=None, memory=None, workers=1, dtype=np.float32, selection=None, read_ahead=2,
+                       sky='median', binning=1):
+    """updates the model store (a folder) with the images of the folder "file".
+
+    The store keeps the fringe map of each sample (store/fringe_maps.npy) and the list of the images
+    of each sample with their size and modification time (store/store.json).
+    During an update, store.json is only written at the beginning and at the end,
+    the samples done in between are recorded by one line each in store/updates.jsonl.
+    Each image always goes in the same sample, so only the samples with new, modified or removed images
+    are made again. The other fringe maps are taken as they are.
+
+    N_samples : number of samples of the store. If None, the number of samples of the existing store is used,
+    or the number of images for a new store. Changing it rebuilds the whole store.
+    memory, workers, dtype, selection, read_ahead, sky, binning : see gather_normalized_images.
+    Changing dtype, sky or binning rebuilds the whole store.
+
+    returns the fringe maps of all the samples which are not empty, and their number"""
+
+    if not os.path.exists(store):
+        os.mkdir(store)
+    info_name = os.path.join(store, 'store.json')
+    maps_name = os.path.join(store, 'fringe_maps.npy')
+    log_name = os.path.join(store, 'updates.jsonl')
+
+    # gets all the images and their signatures, from the catalogue of the headers of the folder
+    if selection is None:
+        selection = {}
+    fringe_filename_arr = hi.select_images(file, **selection)
+    N_images = len(fringe_filename_arr)
+    images = {os.path.basename(name) : [name, hi.file_signature(name)] for name in fringe_filename_arr}
 
-            # checks the size of the image
-            if data_fringe.shape != image_shape:
-                print('%s != %s' % (str(data_fringe.shape), str(image_shape)))
-                print('** ALL IMAGES MUST BE THE SAME SIZE **')
-                print('** EXITING **')
-                sys.exit(0)
+    # Determines the image_shape
+    image_shape = catalogue_shape(file, fringe_filename_arr[0])
+
+    info = None
+    if os.path.exists(info_name):
+        with open(info_name, 'r') as f:
+            info = json.load(f)
+        # the samples done by an interrupted update
+        for record in read_records(log_name):
+            info['samples'][str(record['sample'])] = record['images']
+        if N_samples is None:
+            N_samples = info['N_samples']
+        if ((info['N_samples'] != N_samples) or (tuple(info['image shape']) != image_shape)
+                or (info.get('dtype') != np.dtype(dtype).name) or (info.get('sky', 'median') != sky)
+                or (info.get('binning', 1) != binning) or not os.path.exists(maps_name)):
+            print('the number of samples, the image shape, the type, the sky estimator or the binning changed, the model store is made again')
+            info = None
+    if N_samples is None:
+        N_samples = N_images
 
-            # generates the normalized image
-            median = np.median(data_fringe)
-            data_fringe -= median
-            # stocking
-            sample[i] = data_fringe
-            del data_fringe #clear variables
-
-        # takes the median of the sample and then put i in fringe_maps
-        sample_median = np.median(sample, axis=0)
-        fringe_maps.append(sample_median)
-    
-    return fringe_maps, N_samples
+    if info is None:
+        # the old information is forgotten before the fringe maps are emptied
+        for name in (info_name, log_name):
+            if os.path.exists(name):
+                os.remove(name)
+        info = {'N_samples' : N_samples, 'image shape' : list(image_shape), 'dtype' : np.dtype(dtype).name, 'sky' : sky,
+                'binning' : binning, 'samples' : {str(id_sample) : {} for id_sample in range(N_samples)}}
+        fringe_maps = np.lib.format.open_memmap(maps_name, mode='w+', dtype=dtype,
+                                                shape=(N_samples,) + binned_shape(image_shape, binning))
+        del fringe_maps
+
+    # the new content of each sample
+    samples = {str(id_sample) : {} for id_sample in range(N_samples)}
+    for name in images:
+        samples[str(store_sample_id(name, N_samples))][name] = images[name][1]
+
+    # the samples which changed
+    to_do = [id_sample for id_sample in range(N_samples)
+             if samples[str(id_sample)] != info['samples'][str(id_sample)]]
+    print('%i image on disk | %i samples -> %i samples to update' % (N_images, N_samples, len(to_do)))
+
+    # the changed samples are marked as empty until their fringe map is done,
+    # so that an interrupted update is never taken for a complete one, and starts again from the samples done
+    for id_sample in to_do:
+        info['samples'][str(id_sample)] = {}
+    write_store_info(info_name, info)
+    open(log_name, 'w').close()
+
+    def mark_done(id_sample):
+        append_record(log_name, {'sample' : int(id_sample), 'images' : samples[str(id_sample)]})
+
+    maps_shape = (N_samples,) + binned_shape(image_shape, binning)
+    tasks = []
+    for id_sample in to_do:
+        names = [images[name][0] for name in sorted(samples[str(id_sample)])]
+        if len(names) > 0:
+            tasks.append((id_sample, names, image_shape, memory, maps_shape, None, maps_name, dtype, read_ahead, sky, binning))
+    run_sample_tasks(tasks, workers, done=mark_done)
+
+    # the empty samples
+    for id_sample in to_do:
+        info['samples'][str(id_sample)] = samples[str(id_sample)]
+    write_store_info(info_name, info)
+    os.remove(log_name)
+
+    # only the samples with images are used for the model
+    fringe_maps = np.load(maps_name, mmap_mode='r')
+    fringe_maps = [fringe_maps[id_sample] for id_sample in range(N_samples) if len(samples[str(id_sample)]) > 0]
+
+    return fringe_maps, len(fringe_maps)
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
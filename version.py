@@ -1,22 +1,22 @@
 def version_utils():
     """gives the version of utils.py"""
-    return "1.2.0"
+    return "1.17.11"
 
 def version_data():
     """gives the version of gather_data.py"""
-    return "1.1.1"
+    return "1.7.4"
 
 def version_model():
     """gives the version of model.py"""
-    return "1.2.0"
+    return "1.17.5"
 
 def version_remove():
     """gives the version of remove_fringing.py"""
-    return "1.0.0"
+    return "1.10.7"
 
 def version_all():
     """gives the version of the entire script"""
-    return "1.3.0"
+    return "1.28.25"
 
 if __name__ == "__main__":
     print("script version : {}\n".format(version_all()))